@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Render a copy of an IDML template for each XML payload, in parallel.
+
+The payloads are XML files or directories of XML files. With `-' the XML
+filenames are read from the standard input.
+"""
+
+import glob
+import os
+import sys
+from optparse import OptionParser
+from simple_idml.extras import render_xml_payloads
+
+
+def main():
+    usage = "usage: %prog [options] /path/to/template.idml /path/to/payloads [...] /path/to/output-dir"
+    version = "%prog 0.1"
+    parser = OptionParser(usage=usage, version=version, description=__doc__)
+    parser.add_option("--at", default="/Root",
+                      help=u"XML Structure path where the payloads are imported.")
+    parser.add_option("-p", "--processes", type="int", default=None,
+                      help=u"Number of worker processes (default: the CPU count).")
+    parser.add_option("--no-plan", dest="no_plan", action="store_true", default=False,
+                      help=u"Do not compile an import plan of the template.")
+    (options, args) = parser.parse_args()
+
+    if len(args) < 3:
+        parser.error("You must provide the template, the payloads and the output directory")
+
+    template, sources, output_dir = args[0], args[1:-1], args[-1]
+    payloads = []
+    for source in sources:
+        if source == "-":
+            payloads.extend([line.strip() for line in sys.stdin if line.strip()])
+        elif os.path.isdir(source):
+            payloads.extend(sorted(glob.glob(os.path.join(source, "*.xml"))))
+        else:
+            payloads.append(source)
+
+    results = render_xml_payloads(template, payloads, output_dir, at=options.at,
+                                  processes=options.processes, use_plan=not options.no_plan)
+    errors = 0
+    for result in results:
+        if result["error"]:
+            errors += 1
+            print "%s: error\n%s" % (result["name"], result["error"])
+        else:
+            print "%s: %s (%.3fs)" % (result["name"], result["destination"], result["duration"])
+    sys.exit(errors and 1 or 0)
+
+
+if __name__ == "__main__":
+    main()
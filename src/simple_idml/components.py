@@ -1,17 +1,26 @@
 # -*- coding: utf-8 -*-
 
+import bisect
 import copy
 import os
 import re
+import zipfile
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from decimal import Decimal
 from lxml import etree
 from simple_idml import IdPkgNS, BACKINGSTORY
-from simple_idml.utils import increment_xmltag_id, prefix_content_filename
+from simple_idml.geometry import get_geometry_engine, invert_transform, multiply_transforms, to_decimal
+from simple_idml.utils import get_document_position, increment_xmltag_id, prefix_content_filename
 from simple_idml.utils import Proxy
+from simple_idml.working_copy import DiskWorkingCopy, get_working_copy
 
 RECTO = "recto"
 VERSO = "verso"
 
+# The points of the path of a page item, relative to the item.
+PATH_POINTS_PATH = "Properties/PathGeometry/GeometryPathType/PathPointArray/PathPointType"
+
 rx_node_name_from_xml_name = re.compile(r"[\w]+/[\w]+_([\w]+)\.xml")
 
 
@@ -48,23 +57,39 @@ class IDMLXMLFile(object):
         "StrokeColor",
         "ItemLayer",
     )
+    # Attributes indexed for get_element_by_id().
+    indexed_attrs = (
+        "Self",
+        "ParentStory",
+        "XMLContent",
+    )
 
-    def __init__(self, idml_package, working_copy_path=None):
+    def __init__(self, idml_package, working_copy=None):
         self.idml_package = idml_package
-        self.working_copy_path = working_copy_path
+        self.working_copy = get_working_copy(working_copy)
+        # Set by the methods modifying the DOM (see `set_dirty()').
+        self.dirty = False
         self._fobj = None
         self._dom = None
+        self._index = None
 
     def __repr__(self):
         return "<%s object %s at %s>" % (self.__class__.__name__,
                                          self.name, hex(id(self)))
 
+    @property
+    def working_copy_path(self):
+        return getattr(self.working_copy, "path", None)
+
+    @working_copy_path.setter
+    def working_copy_path(self, path):
+        self.working_copy = path and DiskWorkingCopy(path) or None
+
     @property
     def fobj(self):
         if self._fobj is None:
-            if self.working_copy_path:
-                filename = os.path.join(self.working_copy_path, self.name)
-                fobj = open(filename, mode="r+")
+            if self.working_copy is not None:
+                fobj = self.working_copy.open(self.name, mode="r+")
             else:
                 fobj = self.idml_package.open(self.name, mode="r")
             self._fobj = fobj
@@ -73,12 +98,30 @@ class IDMLXMLFile(object):
     @property
     def dom(self):
         if self._dom is None:
-            dom = etree.fromstring(self.fobj.read())
+            # The working copy may keep the DOM of the files already synchronized.
+            dom = None
+            if self.working_copy is not None:
+                dom = self.working_copy.get_dom(self.name)
+            if dom is None:
+                dom = etree.fromstring(self.read())
             self._dom = dom
-            self._fobj.close()
-            self._fobj = None
         return self._dom
 
+    def read(self):
+        """Return the content of the file. """
+        content = self.fobj.read()
+        self._fobj.close()
+        self._fobj = None
+        return content
+
+    def write(self, content):
+        """Replace the content of the file in the working copy, the DOM is parsed again. """
+        fobj = self.working_copy.open(self.name, mode="w+")
+        fobj.write(content)
+        fobj.close()
+        self._dom = None
+        self.reset_index()
+
     def tostring(self):
         kwargs = {"xml_declaration": True,
                   "encoding": "UTF-8",
@@ -98,27 +141,92 @@ class IDMLXMLFile(object):
             s = etree.tostring(self.dom, **kwargs)
         return s
 
+    def set_dirty(self):
+        """Must be called by the code modifying the DOM: only the dirty files are synchronized. """
+        self.dirty = True
+
     def synchronize(self):
+        """Write the DOM in the working copy. Nothing is done if the DOM was not modified. """
+        if not self.dirty:
+            return
+
         # Explicit initialization of dom from self._fobj before reset
         # because in tostring() we get the dom from this file if None.
         self.dom
-        self.fobj.close()
-        self._fobj = None
+        if self._fobj is not None:
+            self._fobj.close()
+            self._fobj = None
 
         # Must instanciate with a working_copy to use this.
-        fobj = open(os.path.join(self.working_copy_path, self.name), mode="w+")
-        fobj.write(self.tostring())
-        fobj.close()
+        self.working_copy.synchronize(self)
+        self.dirty = False
+
+    @property
+    def index(self):
+        """{(attr, value): [elements]} for the `indexed_attrs', in the document order. """
+        if self._index is None:
+            index = {}
+            for elt in self.dom.iter(tag=etree.Element):
+                for attr in self.indexed_attrs:
+                    value = elt.get(attr)
+                    if value is not None:
+                        index.setdefault((attr, value), []).append(elt)
+            self._index = index
+        return self._index
+
+    def index_element(self, element):
+        """Index (or re-index) `element' and its descendants after they are added in the DOM. """
+        if self._index is None:
+            return
+        for elt in element.iter(tag=etree.Element):
+            for attr in self.indexed_attrs:
+                value = elt.get(attr)
+                if value is None:
+                    continue
+                elements = self._index.setdefault((attr, value), [])
+                if elt not in elements:
+                    elements.append(elt)
+                    # `elt' may be inserted before the elements already indexed.
+                    if len(elements) > 1:
+                        elements.sort(key=get_document_position)
+
+    def unindex_element(self, element):
+        """Remove `element' and its descendants from the index before they leave the DOM. """
+        if self._index is None:
+            return
+        for elt in element.iter(tag=etree.Element):
+            for attr in self.indexed_attrs:
+                elements = self._index.get((attr, elt.get(attr)), [])
+                if elt in elements:
+                    elements.remove(elt)
+
+    def reset_index(self):
+        """Must be called when the indexed attributes are massively modified. """
+        self._index = None
+
+    def _is_in_dom(self, element):
+        root = element
+        for root in element.iterancestors():
+            pass
+        return root is self.dom
 
     def get_element_by_id(self, value, tag="XMLElement", attr="Self"):
-        elem = self.dom.xpath("//%s[@%s='%s']" % (tag, attr, value))
-        # etree FutureWarning when trying to simply do: elem = len(elem) and elem[0] or None
-        if len(elem):
-            elem = elem[0]
-            if elem.tag == "XMLElement":
-                elem = XMLElement(elem)
-        else:
+        if attr in self.indexed_attrs:
             elem = None
+            elements = self.index.get((attr, value), [])
+            for elt in list(elements):
+                # Elements removed or modified without a call to unindex_element().
+                if elt.get(attr) != value or not self._is_in_dom(elt):
+                    elements.remove(elt)
+                elif tag == "*" or elt.tag == tag:
+                    elem = elt
+                    break
+        else:
+            elem = self.dom.xpath("//%s[@%s='%s']" % (tag, attr, value))
+            # etree FutureWarning when trying to simply do: elem = len(elem) and elem[0] or None
+            elem = len(elem) and elem[0] or None
+        if elem is not None and elem.tag == "XMLElement":
+            elem = XMLElement(elem)
         return elem
 
     def prefix_references(self, prefix):
@@ -150,6 +258,8 @@ class IDMLXMLFile(object):
         if elt and elt[0].get("StoryList"):
             elt[0].set("StoryList", " ".join(["%s%s" % (prefix, s)
                                               for s in elt[0].get("StoryList").split(" ")]))
+        self.reset_index()
+        self.set_dirty()
 
     def set_element_resource_path(self, element_id, resource_path, synchronize=False):
         """ For Spread and Story subclasses only (this comment is a call for a Mixin). """
@@ -160,6 +270,7 @@ class IDMLXMLFile(object):
         link = elt.find("Link")
         if link is not None:
             link.set("LinkResourceURI", resource_path)
+            self.set_dirty()
             if synchronize:
                 self.synchronize()
 
@@ -171,14 +282,16 @@ class IDMLXMLFile(object):
         if elt.get("XMLContent"):
             elt.attrib.pop("XMLContent")
         for c in elt.iterchildren():
+            self.unindex_element(c)
             elt.remove(c)
+        self.set_dirty()
         if synchronize:
             self.synchronize()
 
 
 class MasterSpread(IDMLXMLFile):
-    def __init__(self, idml_package, name, working_copy_path=None):
-        super(MasterSpread, self).__init__(idml_package, working_copy_path)
+    def __init__(self, idml_package, name, working_copy=None):
+        super(MasterSpread, self).__init__(idml_package, working_copy)
         self.name = name
 
 
@@ -208,11 +321,14 @@ class Spread(IDMLXMLFile):
                         ˇ +Y
     """
 
-    def __init__(self, idml_package, name, working_copy_path=None):
-        super(Spread, self).__init__(idml_package, working_copy_path)
+    def __init__(self, idml_package, name, working_copy=None):
+        super(Spread, self).__init__(idml_package, working_copy)
         self.name = name
         self._pages = None
         self._node = None
+        self._layer_items_count = None
+        self._layer_guides_count = None
+        self._geometry_index = None
 
     @property
     def pages(self):
@@ -242,6 +358,8 @@ class Spread(IDMLXMLFile):
         for item in page.page_items:
             self.node.append(copy.deepcopy(item))
         self._pages = None
+        self.reset_index()
+        self.set_dirty()
 
         # Correct the position of the new page in the Spread.
         last_page = self.pages[-1]
@@ -263,6 +381,8 @@ class Spread(IDMLXMLFile):
             self.node.set(k, v)
 
         self._pages = None
+        self.reset_index()
+        self.set_dirty()
 
     def get_node_name_from_xml_name(self):
         return rx_node_name_from_xml_name.match(self.name).groups()[0]
@@ -271,18 +391,163 @@ class Spread(IDMLXMLFile):
         for elt in self.dom.iter():
             if elt.get("ItemLayer"):
                 elt.set("ItemLayer", layer_id)
+                self.set_dirty()
+        self.reset_layer_counts()
         self.synchronize()
 
+    @property
+    def layer_items_count(self):
+        """{layer_id: number of page items on the layer}. """
+        if self._layer_items_count is None:
+            self._count_layer_references()
+        return self._layer_items_count
+
+    @property
+    def layer_guides_count(self):
+        """{layer_id: number of guides on the layer}. """
+        if self._layer_guides_count is None:
+            self._count_layer_references()
+        return self._layer_guides_count
+
+    def _count_layer_references(self):
+        items_count = {}
+        guides_count = {}
+        for elt in self.node.iterdescendants(tag=etree.Element):
+            layer_id = elt.get("ItemLayer")
+            if layer_id is None:
+                continue
+            # The page Guide are not page items.
+            if elt.tag == "Guide":
+                guides_count[layer_id] = guides_count.get(layer_id, 0) + 1
+            else:
+                items_count[layer_id] = items_count.get(layer_id, 0) + 1
+        self._layer_items_count = items_count
+        self._layer_guides_count = guides_count
+
+    def reset_layer_counts(self):
+        """Must be called when elements are added, removed or moved to another layer. """
+        self._layer_items_count = None
+        self._layer_guides_count = None
+
+    @property
+    def geometry_engine(self):
+        """The engine of the package moving the page items. See simple_idml.geometry. """
+        return get_geometry_engine(getattr(self.idml_package, "geometry_engine", None))
+
+    @property
+    def geometry_index(self):
+        """The SpreadGeometryIndex of the page items. """
+        if self._geometry_index is None:
+            self._geometry_index = SpreadGeometryIndex(self)
+        return self._geometry_index
+
+    def reset_geometry_index(self):
+        """Must be called when page items or pages are added, removed or moved. """
+        self._geometry_index = None
+
+    def get_page_items(self, page):
+        """The page items of `page', a Page of the spread or its position in `pages'. """
+        if not isinstance(page, Page):
+            page = self.pages[page]
+        return self.geometry_index.get_page_items(page)
+
+    def get_items_in_rectangle(self, x1, y1, x2, y2):
+        """The page items whose bounding box intersects the rectangle, in the Spread coordinates. """
+        return self.geometry_index.get_items_in_rectangle(x1, y1, x2, y2)
+
+    def transform_items(self, selector, matrix, synchronize=False):
+        """Apply the affine `matrix' to the page items selected in a single pass of the geometry engine.
+
+        `selector' is a XPath expression evaluated on the <Spread> node or a list of elements
+        or `Self' values. `matrix' is (a b c d tx ty), as a list or a string, in the Spread
+        coordinates. An item nested in another selected item moves with it and is not
+        transformed again. Return the transformed items.
+        """
+        if isinstance(selector, basestring):
+            items = self.node.xpath(selector)
+        else:
+            items = [self.get_element_by_id(item, tag="*") if isinstance(item, basestring) else item
+                     for item in selector]
+        if isinstance(matrix, basestring):
+            matrix = matrix.split(" ")
+
+        selected_items = set([item for item in items if item is not None])
+        transformed_items = []
+        seen_items = set()
+        for item in items:
+            # An item selected twice is transformed once.
+            if item is None or item in seen_items or item.get("ItemTransform") is None or \
+               any(ancestor in selected_items for ancestor in item.iterancestors()):
+                continue
+            seen_items.add(item)
+            transformed_items.append(item)
+
+        matrix = [to_decimal(v) for v in matrix]
+        parent_matrices = {self.node: matrix}
+        matrices = []
+        for item in transformed_items:
+            parent = item.getparent()
+            # The nested items are transformed in the coordinates of their parent.
+            if parent not in parent_matrices:
+                parent_transform = self._get_spread_transform(parent)
+                parent_matrices[parent] = multiply_transforms(invert_transform(parent_transform),
+                                                              multiply_transforms(matrix, parent_transform))
+            matrices.append(parent_matrices[parent])
+        # All the items are transformed by a single call of the engine.
+        self.geometry_engine.transform_each(transformed_items, matrices)
+        if transformed_items:
+            self.reset_geometry_index()
+            self.set_dirty()
+        if synchronize:
+            self.synchronize()
+        return transformed_items
+
+    def _get_spread_transform(self, element):
+        """The transformation from the coordinates of `element' to the Spread ones. """
+        transform = [Decimal(1), Decimal(0), Decimal(0), Decimal(1), Decimal(0), Decimal(0)]
+        while element is not None and element is not self.node:
+            if element.get("ItemTransform") is not None:
+                transform = multiply_transforms(SpreadGeometryIndex.get_item_transform(element), transform)
+            element = element.getparent()
+        return transform
+
+    def get_item_page(self, item_id):
+        """The Page of the page item `item_id' (or of the page item holding it), None if it has no page. """
+        item = self.get_element_by_id(item_id, tag="*")
+        if item is None:
+            return None
+        while item.getparent() is not None and item.getparent() is not self.node:
+            item = item.getparent()
+        return self.geometry_index.get_item_page(item)
+
+    def index_element(self, element):
+        super(Spread, self).index_element(element)
+        self.reset_layer_counts()
+        self.reset_geometry_index()
+
+    def unindex_element(self, element):
+        super(Spread, self).unindex_element(element)
+        self.reset_layer_counts()
+        self.reset_geometry_index()
+
+    def reset_index(self):
+        super(Spread, self).reset_index()
+        self.reset_layer_counts()
+        self.reset_geometry_index()
+
     def has_any_item_on_layer(self, layer_id):
-        # The page Guide are not page items.
-        return bool(len(self.node.xpath(".//*[not(self::Guide)][@ItemLayer='%s']" % layer_id)))
+        return layer_id in self.layer_items_count
 
     def has_any_guide_on_layer(self, layer_id):
-        return bool(len(self.node.xpath(".//Guide[@ItemLayer='%s']" % layer_id)))
+        return layer_id in self.layer_guides_count
 
     def remove_guides_on_layer(self, layer_id, synchronize=False):
+        if not self.has_any_guide_on_layer(layer_id):
+            return
         for guide in self.node.xpath(".//Guide[@ItemLayer='%s']" % layer_id):
+            self.unindex_element(guide)
             guide.getparent().remove(guide)
+            self.set_dirty()
         if synchronize:
             self.synchronize()
 
@@ -291,7 +556,9 @@ class Spread(IDMLXMLFile):
         elt = self.get_element_by_id(item_id, tag="*")
         if elt is None:
             elt = self.get_element_by_id(item_id, tag="*", attr="ParentStory")
+        self.unindex_element(elt)
         elt.getparent().remove(elt)
+        self.set_dirty()
         if synchronize:
             self.synchronize()
 
@@ -309,32 +576,31 @@ class Spread(IDMLXMLFile):
             # There is not such subelement.
             except TypeError:
                 pass
+        self.unindex_element(rectangle)
         rectangle.addnext(textframe)
         self.node.remove(rectangle)
+        self.index_element(textframe)
+        self.set_dirty()
 
 
 STORIES_DIRNAME = "Stories"
 
 
 class Story(IDMLXMLFile):
-    def __init__(self, idml_package, name, working_copy_path=None):
-        super(Story, self).__init__(idml_package, working_copy_path)
+    def __init__(self, idml_package, name, working_copy=None):
+        super(Story, self).__init__(idml_package, working_copy)
         self.name = name
         self.node_name = "Story"
         self._node = None
 
     @classmethod
-    def create(cls, idml_package, story_id, xml_element_id, xml_element_tag, working_copy_path):
-        dirname = os.path.join(working_copy_path, STORIES_DIRNAME)
-        if not os.path.exists(dirname):
-            os.mkdir(dirname)
+    def create(cls, idml_package, story_id, xml_element_id, xml_element_tag, working_copy):
         story_name = "%s/Story_%s.xml" % (STORIES_DIRNAME, story_id)
-        story = Story(idml_package, story_name, working_copy_path)
+        story = Story(idml_package, story_name, working_copy)
 
         # Difficult to do it in .fobj() because we don't always need
         # to create a unexisting file.
-        filename = os.path.join(working_copy_path, story_name)
-        story._fobj = open(filename, mode="w+")
+        story._fobj = story.working_copy.open(story_name, mode="w+")
         story.fobj.write(
             """<?xml version='1.0' encoding='UTF-8' standalone='yes'?>
    <idPkg:Story xmlns:idPkg="http://ns.adobe.com/AdobeInDesign/idml/1.0/packaging" DOMVersion="7.5">
@@ -364,12 +630,15 @@ class Story(IDMLXMLFile):
     def set_element_attributes(self, element_id, attrs):
         element = self.get_element_by_id(element_id)
         element.set_attributes(attrs)
+        self.index_element(element.element)
+        self.set_dirty()
 
     def set_element_content(self, element_id, content):
         self.clear_element_content(element_id)
         xml_element = self.get_element_by_id(element_id)
         xml_element.set_content(content)
         self._fix_siblings_style(xml_element)
+        self.set_dirty()
 
     def _fix_siblings_style(self, xml_element):
         """Fix ticket #11 when importing XML."""
@@ -398,6 +667,7 @@ class Story(IDMLXMLFile):
             element.remove(c)
         for content_node in self.get_element_content_nodes(element):
             content_node.text = ""
+        self.set_dirty()
 
     def get_element_content_nodes(self, element):
         return element.xpath(("./ParagraphStyleRange/CharacterStyleRange/Content | "
@@ -430,13 +700,18 @@ class Story(IDMLXMLFile):
 
     def remove_element(self, element_id, synchronize=False):
         elt = self.get_element_by_id(element_id).element
+        self.unindex_element(elt)
         elt.getparent().remove(elt)
+        self.set_dirty()
         if synchronize:
             self.synchronize()
 
     def remove_children(self, element_id, synchronize=False):
         elt = self.get_element_by_id(element_id).element
-        map(lambda c: elt.remove(c), elt.iterchildren())
+        for c in elt.iterchildren():
+            self.unindex_element(c)
+            elt.remove(c)
+        self.set_dirty()
         if synchronize:
             self.synchronize()
 
@@ -444,16 +719,19 @@ class Story(IDMLXMLFile):
         node = self.get_element_by_id(element_destination_id)
         node.append(element)
         self.set_element_id(element)
+        self.index_element(element)
+        self.set_dirty()
 
     def add_content_to_element(self, element_id, content, parent=None):
         element = self.get_element_by_id(element_id)
         xml_element = XMLElement(element=element)
         xml_element.add_content(content, parent)
+        self.set_dirty()
 
 
 class BackingStory(Story):
-    def __init__(self, idml_package, name=BACKINGSTORY, working_copy_path=None):
-        super(BackingStory, self).__init__(idml_package, name, working_copy_path)
+    def __init__(self, idml_package, name=BACKINGSTORY, working_copy=None):
+        super(BackingStory, self).__init__(idml_package, name, working_copy)
         self.node_name = "XmlStory"
 
     def get_root(self):
@@ -465,8 +743,8 @@ class Designmap(IDMLXMLFile):
     doctype = u'<?aid style="50" type="document" readerVersion="6.0" featureSet="257" product="7.5(142)" ?>'
     page_start_attr = "PageStart"
 
-    def __init__(self, idml_package, working_copy_path):
-        super(Designmap, self).__init__(idml_package, working_copy_path)
+    def __init__(self, idml_package, working_copy):
+        super(Designmap, self).__init__(idml_package, working_copy)
         self._spread_nodes = None
         self._style_mapping_node = None
         self._section_node = None
@@ -498,12 +776,14 @@ class Designmap(IDMLXMLFile):
     def active_layer(self, layer):
         self.dom.set("ActiveLayer", layer)
         self._active_layer = layer
+        self.set_dirty()
 
     @active_layer.deleter
     def active_layer(self):
         if self.dom.get("ActiveLayer"):
             del self.dom.attrib["ActiveLayer"]
         self._active_layer = None
+        self.set_dirty()
 
     @property
     def section_node(self):
@@ -525,12 +805,14 @@ class Designmap(IDMLXMLFile):
         self.dom.append(
             etree.Element("{%s}Mapping" % IdPkgNS, src=StyleMapping.name)
         )
+        self.set_dirty()
 
     def add_spread(self, spread):
         if self.spread_nodes:
             self.spread_nodes[-1].addnext(
                 etree.Element("{%s}Spread" % IdPkgNS, src=spread.name)
             )
+            self.set_dirty()
 
     def prefix(self, prefix):
         self.prefix_active_layer(prefix)
@@ -543,6 +825,7 @@ class Designmap(IDMLXMLFile):
         section_node = self.section_node
         current_page_start = section_node.get(self.page_start_attr)
         section_node.set(self.page_start_attr, "%s%s" % (prefix, current_page_start))
+        self.set_dirty()
 
     def add_stories(self, stories):
         # Add stories in StoryList.
@@ -554,19 +837,25 @@ class Designmap(IDMLXMLFile):
         for story in stories:
             elt.append(etree.Element("{http://ns.adobe.com/AdobeInDesign/idml/1.0/packaging}Story",
                                      src="Stories/Story_%s.xml" % story))
+        self.set_dirty()
 
     def add_layer_nodes(self, layer_nodes):
         current_layers_ids = [l.get("Self") for l in self.layer_nodes]
         for layer in reversed(layer_nodes):
             # If a similar layer is already present, we do not add it.
             if layer.get("Self") not in current_layers_ids:
-                self.layer_nodes[-1].addnext(copy.deepcopy(layer))
+                layer = copy.deepcopy(layer)
+                self.layer_nodes[-1].addnext(layer)
+                self.index_element(layer)
+                self.set_dirty()
         self._layer_nodes = None
 
     def remove_layer(self, layer_id, synchronize=False):
         layer = self.get_element_by_id(layer_id, tag="Layer", attr="Self")
+        self.unindex_element(layer)
         layer.getparent().remove(layer)
         self._layer_nodes = None
+        self.set_dirty()
         if self.active_layer == layer_id:
             del self.active_layer
             # Change the active layer if some remains.
@@ -578,15 +867,18 @@ class Designmap(IDMLXMLFile):
     def suffix_layers(self, suffix):
         for layer in self.layer_nodes:
             layer.set("Name", "%s%s" % (layer.get("Name"), suffix))
+        self.set_dirty()
 
     def merge_layers(self, with_name=None):
         layer_0 = self.layer_nodes.pop(0)
         if with_name:
             layer_0.set("Name", with_name)
         for l in self.layer_nodes:
+            self.unindex_element(l)
             l.getparent().remove(l)
         self._layer_nodes = None
         self.active_layer = layer_0.get("Self")
+        self.set_dirty()
         self.synchronize()
 
     def get_layer_id_by_name(self, layer_name):
@@ -601,11 +893,14 @@ class Designmap(IDMLXMLFile):
 class Style(IDMLXMLFile):
     name = "Resources/Styles.xml"
 
-    def __init__(self, idml_package, working_copy_path=None):
-        super(Style, self).__init__(idml_package, working_copy_path)
+    def __init__(self, idml_package, working_copy=None):
+        super(Style, self).__init__(idml_package, working_copy)
 
     def get_style_node_by_name(self, style_name):
-        return self.dom.xpath(".//CharacterStyle[@Self='%s']" % style_name)[0]
+        style_node = self.get_element_by_id(style_name, tag="CharacterStyle")
+        if style_node is None:
+            raise IndexError(u"No CharacterStyle named '%s'." % style_name)
+        return style_node
 
     def style_groups(self):
         """ Groups are `RootCharacterStyleGroup', `RootParagraphStyleGroup' etc. """
@@ -615,6 +910,39 @@ class Style(IDMLXMLFile):
     def get_root(self):
         return self.dom.xpath("/idPkg:Styles", namespaces={'idPkg': IdPkgNS})[0]
 
+    def add_style_group(self, style_group):
+        """Add a copy of the styles of `style_group' missing in the group of the same tag.
+
+        The styles are identified by their tag and `Self' value among the children of the group,
+        a style of another group does not count. The nested groups already in the file are
+        completed the same way. The group is added as a whole if the file does not have it.
+        """
+        root_group = self.get_root().find(style_group.tag)
+        if root_group is None:
+            root_group = copy.deepcopy(style_group)
+            self.get_root().append(root_group)
+            self.index_element(root_group)
+            self.set_dirty()
+            return root_group
+
+        groups = [(root_group, style_group)]
+        while groups:
+            group_host, group_to_insert = groups.pop()
+            host_styles = dict([((style.tag, style.get("Self")), style)
+                                for style in group_host.iterchildren(tag=etree.Element)])
+            for style_to_insert in group_to_insert.iterchildren(tag=etree.Element):
+                key = (style_to_insert.tag, style_to_insert.get("Self"))
+                style_node = host_styles.get(key)
+                if style_node is None:
+                    style_node = copy.deepcopy(style_to_insert)
+                    group_host.append(style_node)
+                    self.index_element(style_node)
+                    host_styles[key] = style_node
+                    self.set_dirty()
+                elif style_to_insert.tag.endswith("Group"):
+                    groups.append((style_node, style_to_insert))
+        return root_group
+
 
 class StyleMapping(IDMLXMLFile):
     name = "XML/Mapping.xml"
@@ -623,8 +951,8 @@ class StyleMapping(IDMLXMLFile):
                    DOMVersion=\"7.5\">\
                    </idPkg:Mapping>")
 
-    def __init__(self, idml_package, working_copy_path=None):
-        super(StyleMapping, self).__init__(idml_package, working_copy_path)
+    def __init__(self, idml_package, working_copy=None):
+        super(StyleMapping, self).__init__(idml_package, working_copy)
         self._character_style_mapping = None
 
     @property
@@ -633,7 +961,7 @@ class StyleMapping(IDMLXMLFile):
         try:
             super(StyleMapping, self).fobj
         except (KeyError, IOError):
-            if self.working_copy_path:
+            if self.working_copy is not None:
                 self._initialize_fobj()
         return self._fobj
 
@@ -658,8 +986,7 @@ class StyleMapping(IDMLXMLFile):
         return self._character_style_mapping
 
     def _initialize_fobj(self):
-        filename = os.path.join(self.working_copy_path, self.name)
-        fobj = open(filename, mode="w+")
+        fobj = self.working_copy.open(self.name, mode="w+")
         fobj.write(self.initial_dom)
         fobj.seek(0)
         self._fobj = fobj
@@ -669,8 +996,11 @@ class StyleMapping(IDMLXMLFile):
             yield n
 
     def add_stylenode(self, node):
-        self.dom.append(copy.deepcopy(node))
+        node = copy.deepcopy(node)
+        self.dom.append(node)
+        self.index_element(node)
         self._character_style_mapping = None
+        self.set_dirty()
 
 
 class Graphic(IDMLXMLFile):
@@ -690,9 +1020,29 @@ class Tags(IDMLXMLFile):
     def get_root(self):
         return self.dom.xpath("/idPkg:Tags", namespaces={'idPkg': IdPkgNS})[0]
 
+    def add_tags(self, tags):
+        """Append a copy of the `tags' whose `Self' is not in the file. Return the added tags. """
+        tag_ids = set([tag.get("Self") for tag in self.tags()])
+        tags_root_elt = self.get_root()
+        added_tags = []
+        for tag in tags:
+            if tag.get("Self") in tag_ids:
+                continue
+            tag = copy.deepcopy(tag)
+            tags_root_elt.append(tag)
+            self.index_element(tag)
+            tag_ids.add(tag.get("Self"))
+            added_tags.append(tag)
+            self.set_dirty()
+        return added_tags
+
 
 class Fonts(IDMLXMLFile):
     name = "Resources/Fonts.xml"
+    indexed_attrs = (
+        "Self",
+        "Name",
+    )
 
     def fonts(self):
         return self.dom.xpath("//FontFamily")
@@ -700,6 +1050,62 @@ class Fonts(IDMLXMLFile):
     def get_root(self):
         return self.dom.xpath("/idPkg:Fonts", namespaces={'idPkg': IdPkgNS})[0]
 
+    def get_font_family(self, font_family):
+        """The <FontFamily> of the file with the same `Name' than `font_family'.
+
+        The `Self' values are local to each document: another package may use the same one
+        for another family.
+        """
+        return self.get_element_by_id(font_family.get("Name"), tag="FontFamily", attr="Name")
+
+    def add_font_family(self, font_family):
+        """Add a copy of `font_family' or the <Font> missing in the same family of the file.
+
+        A `Self' value already used in the file is replaced by a new one: the fonts are
+        referenced by their name in the other files.
+        """
+        family = self.get_font_family(font_family)
+        if family is None:
+            family = copy.deepcopy(font_family)
+            family_id = family.get("Self")
+            new_family_id = self.get_unique_id(family_id)
+            family.set("Self", new_family_id)
+            for font in family.iterchildren("Font"):
+                # <FontFamily Self="di3e"><Font Self="di3eFontnMinion Pro Regular" .../>
+                font_id = font.get("Self")
+                if font_id.startswith(family_id):
+                    font_id = "%s%s" % (new_family_id, font_id[len(family_id):])
+                font.set("Self", self.get_unique_id(font_id))
+            self.get_root().append(family)
+            self.index_element(family)
+            self.set_dirty()
+            return family
+
+        font_names = set([font.get("Name") for font in family.iterchildren("Font")])
+        for font in font_family.iterchildren("Font"):
+            if font.get("Name") in font_names:
+                continue
+            # A font with the same `Self' is the same font only if it has the same `Name'.
+            same_font = self.get_element_by_id(font.get("Self"), tag="Font")
+            if same_font is not None and same_font.get("Name") == font.get("Name"):
+                continue
+            font = copy.deepcopy(font)
+            font.set("Self", self.get_unique_id(font.get("Self")))
+            family.append(font)
+            self.index_element(font)
+            font_names.add(font.get("Name"))
+            self.set_dirty()
+        return family
+
+    def get_unique_id(self, value):
+        """Return `value', or `value' with a numbered suffix if an element of the file has this `Self'. """
+        unique_value = value
+        i = 1
+        while self.get_element_by_id(unique_value, tag="*") is not None:
+            unique_value = "%s_%d" % (value, i)
+            i += 1
+        return unique_value
+
 
 class Page(object):
     """
@@ -725,8 +1131,7 @@ class Page(object):
     @property
     def page_items(self):
         if self._page_items is None:
-            page_items = [i for i in self.node.itersiblings()
-                          if not i.tag == "Page" and self.page_item_is_in_self(i)]
+            page_items = self.spread.get_page_items(self)
             self._page_items = page_items
         return self._page_items
 
@@ -757,6 +1162,8 @@ class Page(object):
     @geometric_bounds.setter
     def geometric_bounds(self, matrix):
         self.node.set("GeometricBounds", " ".join([str(v) for v in matrix]))
+        self.spread.reset_geometry_index()
+        self.spread.set_dirty()
 
     @property
     def item_transform(self):
@@ -765,6 +1172,8 @@ class Page(object):
     @item_transform.setter
     def item_transform(self, matrix):
         self.node.set("ItemTransform", " ".join([str(v) for v in matrix]))
+        self.spread.reset_geometry_index()
+        self.spread.set_dirty()
 
     @property
     def coordinates(self):
@@ -789,8 +1198,7 @@ class Page(object):
         """
 
         item_transform = [Decimal(c) for c in page_item.get("ItemTransform").split(" ")]
-        #TODO factoriser "Properties/PathGeometry/GeometryPathType/PathPointArray/PathPointType"
-        point = page_item.xpath("Properties/PathGeometry/GeometryPathType/PathPointArray/PathPointType")[0]
+        point = page_item.xpath(PATH_POINTS_PATH)[0]
         x, y = [Decimal(c) for c in point.get("Anchor").split(" ")]
         x = x + item_transform[4]
         y = y + item_transform[5]
@@ -816,13 +1224,111 @@ class Page(object):
             self.item_transform = item_transform
 
             # All page items are moved according to item_transform_x.
-            for item in self.page_items:
-                item_transform = [Decimal(c) for c in item.get("ItemTransform").split(" ")]
-                item_transform[4] = item_transform[4] + item_transform_x
-                item.set("ItemTransform", " ".join([str(v) for v in item_transform]))
+            self.spread.geometry_engine.translate(self.page_items, (item_transform_x, Decimal("0")))
 
             self._is_recto = None
             self._coordinates = None
+            self.spread.reset_geometry_index()
+
+
+class SpreadGeometryIndex(object):
+    """The position of the page items of a Spread, computed once for the geometry queries.
+
+    For each page item (a child of <Spread> with a path, or with descendants having one):
+     o anchor: the first `PathPointType' translated by the `ItemTransform'. It tells the page
+       of the item like in Page.page_item_is_in_self().
+     o bounding_box: (x1, y1, x2, y2) of the `PathPointType' of the item and of its descendants
+       through their `ItemTransform', in the Spread coordinates.
+
+    The bounding boxes are sorted on x1 so that a rectangle is looked up by bisection.
+    """
+
+    def __init__(self, spread):
+        self.spread = spread
+        self.anchors = {}
+        self.bounding_boxes = {}
+        self.page_items = {}
+        self.item_pages = {}
+        # [(x1, position, element), ...] sorted on x1.
+        self._boxes = []
+        self._boxes_x1 = []
+        self._max_width = Decimal("0")
+        self._build()
+
+    def _build(self):
+        pages = dict([(page.node, page) for page in self.spread.pages])
+        # Like Page.page_items, an item belongs to the pages before it in the Spread.
+        previous_pages = []
+        for position, elt in enumerate(self.spread.node.iterchildren(tag=etree.Element)):
+            if elt.tag == "Page":
+                page = pages.get(elt) or Page(self.spread, elt)
+                previous_pages.append(page)
+                self.page_items[elt] = []
+                continue
+            if elt.get("ItemTransform") is None:
+                continue
+            anchor, bounding_box = self.get_geometry(elt)
+            if anchor is None:
+                continue
+            self.anchors[elt] = anchor
+            self.bounding_boxes[elt] = bounding_box
+            self._boxes.append((bounding_box[0], position, elt))
+            self._max_width = max(self._max_width, bounding_box[2] - bounding_box[0])
+            for page in previous_pages:
+                if page.coordinates["x1"] <= anchor[0] <= page.coordinates["x2"]:
+                    self.page_items[page.node].append(elt)
+                    self.item_pages.setdefault(elt, page)
+        self._boxes.sort(key=lambda box: box[:2])
+        self._boxes_x1 = [box[0] for box in self._boxes]
+
+    @classmethod
+    def get_geometry(cls, item):
+        """(anchor, bounding_box) of `item' in its parent coordinates, (None, None) if it has no path. """
+        item_transform = cls.get_item_transform(item)
+        anchor = None
+        points = item.xpath(PATH_POINTS_PATH)
+        if points:
+            x, y = [Decimal(c) for c in points[0].get("Anchor").split(" ")]
+            anchor = (x + item_transform[4], y + item_transform[5])
+
+        xs, ys = [], []
+        stack = [(item, item_transform)]
+        while stack:
+            elt, (a, b, c, d, tx, ty) = stack.pop()
+            for point in (elt is item and points or elt.xpath(PATH_POINTS_PATH)):
+                x, y = [Decimal(v) for v in point.get("Anchor").split(" ")]
+                xs.append(a * x + c * y + tx)
+                ys.append(b * x + d * y + ty)
+            for child in elt.iterchildren(tag=etree.Element):
+                if child.get("ItemTransform") is not None:
+                    stack.append((child, multiply_transforms((a, b, c, d, tx, ty),
+                                                             cls.get_item_transform(child))))
+        if not xs:
+            return None, None
+        bounding_box = (min(xs), min(ys), max(xs), max(ys))
+        return anchor or bounding_box[:2], bounding_box
+
+    @staticmethod
+    def get_item_transform(elt):
+        return [Decimal(c) for c in elt.get("ItemTransform").split(" ")]
+
+    def get_page_items(self, page):
+        return list(self.page_items.get(page.node, []))
+
+    def get_item_page(self, item):
+        return self.item_pages.get(item)
+
+    def get_items_in_rectangle(self, x1, y1, x2, y2):
+        x1, y1, x2, y2 = [Decimal(c) for c in (x1, y1, x2, y2)]
+        # The boxes starting farther on the left than the widest one cannot reach x1.
+        start = bisect.bisect_left(self._boxes_x1, x1 - self._max_width)
+        end = bisect.bisect_right(self._boxes_x1, x2)
+        items = []
+        for _x1, position, elt in sorted(self._boxes[start:end], key=lambda box: box[1]):
+            box_x1, box_y1, box_x2, box_y2 = self.bounding_boxes[elt]
+            if box_x2 >= x1 and box_y1 <= y2 and box_y2 >= y1:
+                items.append(elt)
+        return items
 
 
 class XMLElement(Proxy):
@@ -959,8 +1465,8 @@ class XMLElement(Proxy):
         return etree.Element(name, **attrs)
 
 
-def get_idml_xml_file_by_name(idml_package, name, working_copy_path=None):
-    kwargs = {"idml_package": idml_package, "name": name, "working_copy_path": working_copy_path}
+def get_idml_xml_file_by_name(idml_package, name, working_copy=None):
+    kwargs = {"idml_package": idml_package, "name": name, "working_copy": working_copy}
     dirname, basename = os.path.split(name)
     if basename == "designmap.xml":
         kwargs.pop("name")
@@ -994,3 +1500,84 @@ def get_idml_xml_file_by_name(idml_package, name, working_copy_path=None):
         klass = StyleMapping
 
     return klass(**kwargs)
+
+
+def parse_idml_xml_files(idml_xml_files, workers=None):
+    """Parse the DOM of several files in a pool of `workers' threads.
+
+    lxml releases the GIL while parsing. The files are read sequentially
+    before because a ZipFile cannot be read by several threads.
+    """
+    to_parse = []
+    for idml_xml_file in idml_xml_files:
+        if idml_xml_file._dom is not None:
+            continue
+        if idml_xml_file.working_copy is not None:
+            idml_xml_file._dom = idml_xml_file.working_copy.get_dom(idml_xml_file.name)
+        if idml_xml_file._dom is None:
+            to_parse.append(idml_xml_file)
+
+    contents = [idml_xml_file.read() for idml_xml_file in to_parse]
+    pool = ThreadPool(workers)
+    try:
+        doms = pool.map(etree.fromstring, contents)
+    finally:
+        pool.close()
+        pool.join()
+    for idml_xml_file, dom in zip(to_parse, doms):
+        idml_xml_file._dom = dom
+
+
+def prefix_idml_xml_files(idml_xml_files, prefix, workers=None):
+    """Prefix the references of several files in a pool of `workers' processes.
+
+    The processes read the files themselves when the working copy can locate them
+    (see WorkingCopy.locate()), the other contents are sent to them. The prefixed
+    contents are written sequentially. The files already parsed in the working
+    copy are prefixed here.
+    """
+    to_prefix = []
+    for idml_xml_file in idml_xml_files:
+        if idml_xml_file.dirty or idml_xml_file.working_copy.get_dom(idml_xml_file.name) is not None:
+            idml_xml_file.prefix_references(prefix)
+            idml_xml_file.synchronize()
+        else:
+            to_prefix.append(idml_xml_file)
+
+    args = []
+    for idml_xml_file in to_prefix:
+        location = idml_xml_file.working_copy.locate(idml_xml_file.name)
+        content = None
+        if location is None:
+            content = idml_xml_file.read()
+        args.append((idml_xml_file.name, location, content, prefix))
+    pool = Pool(workers)
+    try:
+        contents = pool.map(prefix_content, args)
+    finally:
+        pool.close()
+        pool.join()
+    for idml_xml_file, content in zip(to_prefix, contents):
+        idml_xml_file.write(content)
+
+
+# The packages opened by a prefixing process, by filename.
+_prefix_packages = {}
+
+
+def prefix_content(args):
+    """Return the content of a file with its references prefixed (see prefix_idml_xml_files()). """
+    name, location, content, prefix = args
+    if location is not None:
+        filename, member = location
+        if member is None:
+            with open(filename, "rb") as fobj:
+                content = fobj.read()
+        else:
+            if filename not in _prefix_packages:
+                _prefix_packages[filename] = zipfile.ZipFile(filename)
+            content = _prefix_packages[filename].read(member)
+    idml_xml_file = get_idml_xml_file_by_name(None, name)
+    idml_xml_file._dom = etree.fromstring(content)
+    idml_xml_file.prefix_references(prefix)
+    return idml_xml_file.tostring()
@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import glob
+import io
+import multiprocessing
 import os
+import time
+import traceback
 from simple_idml.idml import IDMLPackage
 
 
@@ -16,3 +21,78 @@ def create_idml_package_from_dir(dir_path, package_path=None):
             package.write(os.path.join(root, filename),
                           os.path.join(root.replace(dir_path, "."), filename))
     return package
+
+
+def render_xml_payloads(template_path, payloads, output_dir, at="/Root", processes=None, use_plan=True):
+    """Import each XML payload into a copy of the template and write it in `output_dir'.
+
+    - payloads: a directory of .xml files or an iterable of XML filenames or
+      of (name, xml) pairs. The documents are written as `output_dir'/name.idml.
+    - processes: the size of the process pool (default: the CPU count). With 1,
+      the payloads are rendered in the current process.
+
+    The template is read and its import plan compiled once, before the workers
+    are started (an invalid `at' raises here), and the workers render the
+    payloads on copies kept in memory.
+
+    Return a list of {"name", "destination", "duration", "error"} in the payloads order.
+    `error' is the formatted traceback of a failed job or None.
+    """
+    if isinstance(payloads, basestring):
+        payloads = sorted(glob.glob(os.path.join(payloads, "*.xml")))
+    jobs = ((payload, output_dir) for payload in payloads)
+    with open(template_path, "rb") as fobj:
+        template = fobj.read()
+    plan = None
+    if use_plan:
+        with IDMLPackage(io.BytesIO(template)) as idml_package:
+            plan = idml_package.compile_import_plan(at)
+    initargs = (template, at, plan)
+
+    if processes == 1:
+        _init_render_worker(*initargs)
+        return map(_render_job, jobs)
+
+    pool = multiprocessing.Pool(processes, _init_render_worker, initargs)
+    try:
+        return list(pool.imap(_render_job, jobs))
+    finally:
+        pool.close()
+        pool.join()
+
+
+# The template loaded in a render worker process.
+_render_context = {}
+
+
+def _init_render_worker(template, at, plan):
+    _render_context.update({"template": template, "at": at, "plan": plan})
+
+
+def _render_job(job):
+    payload, output_dir = job
+    start = time.time()
+    if isinstance(payload, basestring):
+        name = os.path.splitext(os.path.basename(payload))[0]
+        xml = None
+    else:
+        name, xml = payload
+    destination = os.path.join(output_dir, "%s.idml" % name)
+
+    error = None
+    try:
+        if xml is None:
+            with open(payload, "r") as fobj:
+                xml = fobj.read()
+        idml_package = IDMLPackage(io.BytesIO(_render_context["template"]))
+        idml_package = idml_package.import_xml(xml, at=_render_context["at"], plan=_render_context["plan"])
+        with open(destination, "wb") as fobj:
+            fobj.write(idml_package.fp.getvalue())
+        idml_package.close()
+    except Exception:
+        error = traceback.format_exc()
+
+    return {"name": name,
+            "destination": destination,
+            "duration": time.time() - start,
+            "error": error}
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""
+Geometry engines moving the page items by rewriting their `ItemTransform' (a b c d tx ty).
+
+A point (x, y) of an item is placed in its parent at (a*x + c*y + tx, b*x + d*y + ty).
+
+The `decimal' engine (the default) computes with Decimal like the rest of the package.
+The `numpy' engine loads the `ItemTransform' of all the elements in a float64 array and
+transforms them at once, with a matrix for all of them or one per element (`transform_each()',
+used by `Spread.transform_items()' for a whole spread). It requires NumPy and is selected
+on the package:
+
+    >>> IDMLPackage.geometry_engine = "numpy"
+
+Precision policy of the `numpy' engine: only the modified values are written, rounded at
+`precision' decimals without exponent and trailing zeros. A value written then loaded
+again is written back identically.
+"""
+
+from decimal import Decimal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class DecimalGeometryEngine(object):
+    name = "decimal"
+
+    def translate(self, elements, translation):
+        """Add the translation (x, y) to the `ItemTransform' of `elements'. """
+        translation_x, translation_y = [to_decimal(v) for v in translation]
+        for element in elements:
+            item_transform = element.get("ItemTransform").split(" ")
+            item_transform[4] = str(Decimal(item_transform[4]) + translation_x)
+            item_transform[5] = str(Decimal(item_transform[5]) + translation_y)
+            element.set("ItemTransform", " ".join(item_transform))
+
+    def transform(self, elements, matrix):
+        """Apply the affine `matrix' (a b c d tx ty) after the `ItemTransform' of `elements'. """
+        self.transform_each(elements, [matrix] * len(elements))
+
+    def transform_each(self, elements, matrices):
+        """Apply each affine matrix of `matrices' after the `ItemTransform' of the element at the same position. """
+        # The matrices shared by several elements are converted once.
+        decimal_matrices = {}
+        for element, matrix in zip(elements, matrices):
+            if id(matrix) not in decimal_matrices:
+                decimal_matrices[id(matrix)] = [to_decimal(v) for v in matrix]
+            ma, mb, mc, md, mtx, mty = decimal_matrices[id(matrix)]
+            values = element.get("ItemTransform").split(" ")
+            a, b, c, d, tx, ty = [Decimal(v) for v in values]
+            item_transform = [ma * a + mc * b,
+                              mb * a + md * b,
+                              ma * c + mc * d,
+                              mb * c + md * d,
+                              ma * tx + mc * ty + mtx,
+                              mb * tx + md * ty + mty]
+            # The unchanged values are kept as they are written.
+            element.set("ItemTransform", " ".join([new != Decimal(value) and self.format(new) or value
+                                                   for new, value in zip(item_transform, values)]))
+
+    def format(self, value):
+        value = format(value, "f")
+        if "." in value:
+            value = value.rstrip("0").rstrip(".")
+        if value == "-0":
+            value = "0"
+        return value
+
+
+class NumpyGeometryEngine(object):
+    name = "numpy"
+    # Number of decimals of the values written.
+    precision = 10
+
+    def __init__(self):
+        if numpy is None:
+            raise ImportError("The numpy geometry engine requires NumPy.")
+
+    def load(self, elements):
+        """Return a (len(elements), 6) float64 array of the `ItemTransform' and their values as strings. """
+        values = [element.get("ItemTransform").split(" ") for element in elements]
+        matrices = numpy.array(values, dtype=numpy.float64).reshape((len(values), 6))
+        return matrices, values
+
+    def dump(self, elements, matrices, values, loaded_matrices):
+        """Write the values of `matrices' different from `loaded_matrices' in the `ItemTransform' of `elements'. """
+        modified = (matrices != loaded_matrices).tolist()
+        for element, matrix, value, row in zip(elements, matrices.tolist(), values, modified):
+            for column in range(6):
+                if row[column]:
+                    value[column] = self.format(matrix[column])
+            element.set("ItemTransform", " ".join(value))
+
+    def format(self, value):
+        value = "%.*f" % (self.precision, value)
+        if "." in value:
+            value = value.rstrip("0").rstrip(".")
+        if value == "-0":
+            value = "0"
+        return value
+
+    def translate(self, elements, translation):
+        """Add the translation (x, y) to the `ItemTransform' of `elements'. """
+        if not elements:
+            return
+        loaded_matrices, values = self.load(elements)
+        matrices = loaded_matrices.copy()
+        matrices[:, 4] += float(translation[0])
+        matrices[:, 5] += float(translation[1])
+        self.dump(elements, matrices, values, loaded_matrices)
+
+    def transform(self, elements, matrix):
+        """Apply the affine `matrix' (a b c d tx ty) after the `ItemTransform' of `elements'. """
+        self.transform_each(elements, [matrix] * len(elements))
+
+    def transform_each(self, elements, matrices):
+        """Apply each affine matrix of `matrices' after the `ItemTransform' of the element at the same position. """
+        if not elements:
+            return
+        loaded_matrices, values = self.load(elements)
+        # The matrices shared by several elements are converted once, then spread on the rows.
+        positions = {}
+        distinct_matrices = []
+        rows = []
+        for matrix in matrices:
+            if id(matrix) not in positions:
+                positions[id(matrix)] = len(distinct_matrices)
+                distinct_matrices.append([float(v) for v in matrix])
+            rows.append(positions[id(matrix)])
+        ma, mb, mc, md, mtx, mty = numpy.array(distinct_matrices, dtype=numpy.float64)[rows].T
+        a, b, c, d, tx, ty = loaded_matrices.T
+        new_matrices = numpy.column_stack((ma * a + mc * b,
+                                           mb * a + md * b,
+                                           ma * c + mc * d,
+                                           mb * c + md * d,
+                                           ma * tx + mc * ty + mtx,
+                                           mb * tx + md * ty + mty))
+        self.dump(elements, new_matrices, values, loaded_matrices)
+
+
+geometry_engines = {
+    DecimalGeometryEngine.name: DecimalGeometryEngine,
+    NumpyGeometryEngine.name: NumpyGeometryEngine,
+}
+
+
+def get_geometry_engine(name=None):
+    """Return an instance of the engine `name' (the `decimal' engine by default). """
+    try:
+        return geometry_engines[name or DecimalGeometryEngine.name]()
+    except KeyError:
+        raise ValueError(u"Unknown geometry engine '%s'." % name)
+
+
+def multiply_transforms(parent, child):
+    """The transformation `child' then `parent', as an `ItemTransform' list (a b c d tx ty). """
+    pa, pb, pc, pd, ptx, pty = parent
+    ca, cb, cc, cd, ctx, cty = child
+    return [pa * ca + pc * cb,
+            pb * ca + pd * cb,
+            pa * cc + pc * cd,
+            pb * cc + pd * cd,
+            pa * ctx + pc * cty + ptx,
+            pb * ctx + pd * cty + pty]
+
+
+def invert_transform(transform):
+    a, b, c, d, tx, ty = transform
+    determinant = a * d - b * c
+    if not determinant:
+        raise ValueError(u"The transformation '%s' cannot be inverted." % " ".join(map(str, transform)))
+    return [d / determinant,
+            -b / determinant,
+            -c / determinant,
+            a / determinant,
+            (c * ty - d * tx) / determinant,
+            (b * tx - a * ty) / determinant]
+
+
+def to_decimal(value):
+    """Floats are converted from their representation rather than their binary value. """
+    if isinstance(value, float):
+        value = repr(value)
+    return Decimal(value)
@@ -1,41 +1,64 @@
 # -*- coding: utf-8 -*-
 
 import copy
+import hashlib
 import os
 import re
-import shutil
 import zipfile
 from decimal import Decimal
 from lxml import etree
 from simple_idml import BACKINGSTORY, SETCONTENT_TAG, IGNORECONTENT_TAG, FORCECONTENT_TAG
-from simple_idml.components import get_idml_xml_file_by_name
-from simple_idml.components import (Designmap, Spread, Story, BackingStory,
-                                    Style, StyleMapping, Graphic, Tags, Fonts, XMLElement)
+from simple_idml.components import get_idml_xml_file_by_name, parse_idml_xml_files, prefix_idml_xml_files
+from simple_idml.components import (Designmap, Story, Style, StyleMapping,
+                                    Graphic, Tags, Fonts, XMLElement)
 from simple_idml.decorators import use_working_copy
+from simple_idml.geometry import get_geometry_engine
 from simple_idml.utils import increment_filename, prefix_content_filename, tree_to_etree_dom
+from simple_idml.working_copy import DiskWorkingCopy, MemoryWorkingCopy, EditSession
 
 STORIES_DIRNAME = "Stories"
+XML_STRUCTURE_CACHE_VERSION = "1"
+# The XPath in the xml_structure made of tags and positions only (/Root/module[1]/Story):
+# they are resolved without discovering the whole structure.
+rx_xml_structure_path = re.compile(r"^(/[\w.:-]+(\[[1-9]\d*\])?)+$")
+rx_xml_structure_step = re.compile(r"/([\w.:-]+)(?:\[(\d+)\])?")
 
 
 class IDMLPackage(zipfile.ZipFile):
     """An IDML file (a package) is a Zip-stored archive/UCF container. """
     debug = False
+    working_copy_class = MemoryWorkingCopy
+    # Directory where the discovered xml_structure are kept between the openings of a package.
+    xml_structure_cache_dir = None
+    # Number of threads parsing the stories when the xml_structure is discovered (0: sequential).
+    xml_structure_workers = 0
+    # Number of processes prefixing the files in prefix() (0: sequential).
+    prefix_workers = 0
+    # Engine moving the page items: "decimal" or "numpy" (requires NumPy). See simple_idml.geometry.
+    geometry_engine = "decimal"
 
     def __init__(self, *args, **kwargs):
         kwargs["compression"] = zipfile.ZIP_STORED
         zipfile.ZipFile.__init__(self, *args, **kwargs)
-        self.working_copy_path = None
+        self._idml_xml_files = {}
+        self.working_copy = None
         self.init_lazy_references()
 
     def __repr__(self):
         return "<idml.IDMLPackage instance of '%s' at %s>" % (
-            os.path.basename(self.filename),
+            os.path.basename(self.filename or ""),
             hex(id(self))
         )
 
-    def init_lazy_references(self):
-        self._xml_structure = None
-        self._xml_structure_tree = None
+    def init_lazy_references(self, xml_structure=True):
+        """Reset the lazy attributes after a modification.
+
+        `xml_structure' may be False when the xml_structure was updated in place.
+        The parsed Story and Spread files are kept: see invalidate_idml_xml_files().
+        """
+        if xml_structure:
+            self._xml_structure = None
+            self._xml_structure_tree = None
         self._designmap = None
         self._tags = None
         self._font_families = None
@@ -45,26 +68,72 @@ class IDMLPackage(zipfile.ZipFile):
         self._graphic = None
         self._spreads = None
         self._spreads_objects = None
+        self._spread_locator = None
         self._pages = None
         self._backing_story = None
         self._stories = None
         self._story_ids = None
         self._referenced_layers = None
 
+    @property
+    def working_copy(self):
+        return self._working_copy
+
+    @working_copy.setter
+    def working_copy(self, working_copy):
+        self._working_copy = working_copy
+        # The shared components read their member in the previous working copy.
+        self.invalidate_idml_xml_files()
+
+    @property
+    def working_copy_path(self):
+        """The working copy location when it is extracted on the filesystem. """
+        return getattr(self.working_copy, "path", None)
+
+    @working_copy_path.setter
+    def working_copy_path(self, path):
+        self.working_copy = path and DiskWorkingCopy(path) or None
+
+    def edit(self):
+        """Apply several modifications with a single working copy. See EditSession. """
+        return EditSession(self)
+
+    def get_idml_xml_file(self, name, shared=True):
+        """Return the shared instance of the component stored in the member `name'.
+
+        The file is parsed once and the same object (and DOM) is returned until
+        `invalidate_idml_xml_files()' is called for this member.
+        With `shared=False', a file without shared instance is read in a private one
+        which is not kept: its DOM is released with it.
+        """
+        idml_xml_file = self._idml_xml_files.get(name)
+        if idml_xml_file is None:
+            idml_xml_file = get_idml_xml_file_by_name(self, name, self.working_copy)
+            if shared:
+                self._idml_xml_files[name] = idml_xml_file
+        return idml_xml_file
+
+    def invalidate_idml_xml_files(self, names=None):
+        """Forget the shared instances of `names' (all of them by default).
+
+        Must be called when a member is written or renamed without its shared instance.
+        """
+        if names is None:
+            self._idml_xml_files = {}
+        else:
+            for name in names:
+                self._idml_xml_files.pop(name, None)
+
+    def synchronize_idml_xml_files(self):
+        """Write the modified shared components in the working copy. """
+        for idml_xml_file in self._idml_xml_files.values():
+            idml_xml_file.synchronize()
+
     def namelist(self):
-        if not self.working_copy_path:
+        if self.working_copy is None:
             return zipfile.ZipFile.namelist(self)
         else:
-            namelist = []
-            for root, dirs, filenames in os.walk(self.working_copy_path):
-                rel_root = root.replace(self.working_copy_path, "")[1:]
-                for filename in filenames:
-                    namelist.append("%(rel_root)s%(sep)s%(filename)s" % {
-                        'rel_root': rel_root,
-                        'sep': rel_root and "/" or "",
-                        'filename': filename
-                    })
-            return namelist
+            return self.working_copy.namelist()
 
     def contentfile_namelist(self):
         """Namelist filtered on Spreads and Stories. """
@@ -77,39 +146,113 @@ class IDMLPackage(zipfile.ZipFile):
         Starting at BackingStory.xml where the root-element is expected (because unused). """
 
         if self._xml_structure is None:
-            source_node = self.backing_story.get_root()
-            structure = source_node.to_xml_structure_element()
-
-            def append_childs(source_node, destination_node):
-                """Recursive function to discover node structure from a story to another. """
-                for elt in source_node.iterchildren():
-                    if not elt.tag == "XMLElement":
-                        append_childs(elt, destination_node)
-                    if elt.get("Self") == source_node.get("Self"):
-                        continue
-                    if not elt.get("MarkupTag"):
-                        continue
-                    elt = XMLElement(elt)
-                    new_destination_node = elt.to_xml_structure_element()
-                    destination_node.append(new_destination_node)
-                    if elt.get("XMLContent"):
-                        xml_content_value = elt.get("XMLContent")
-                        story_name = "Stories/Story_%s.xml" % xml_content_value
-                        story = Story(self, name=story_name)
-                        try:
-                            new_source_node = story.get_element_by_id(elt.get("Self"))
-                        # The story does not exists.
-                        except KeyError:
-                            continue
-                        else:
-                            append_childs(new_source_node, new_destination_node)
-                    else:
-                        append_childs(elt, new_destination_node)
-
-            append_childs(source_node, structure)
+            structure = self._get_cached_xml_structure()
+            if structure is None:
+                structure = self._discover_xml_structure()
+                self._cache_xml_structure(structure)
             self._xml_structure = structure
         return self._xml_structure
 
+    def _discover_xml_structure(self, workers=None):
+        if workers is None:
+            workers = self.xml_structure_workers
+        # The stories are only kept while their elements are walked.
+        stories = {}
+        # Any story may be referenced by a XMLContent: they are all parsed at once.
+        if workers:
+            stories = dict([(name, self.get_idml_xml_file(name, shared=False)) for name in self.stories])
+            parse_idml_xml_files(stories.values(), workers)
+
+        source_node = self.backing_story.get_root()
+        structure = source_node.to_xml_structure_element()
+        self._discover_xml_structure_children(source_node, structure, stories)
+        return structure
+
+    def _discover_xml_structure_children(self, source_node, destination_node, stories=None, shared=False):
+        """Append to `destination_node' the xml_structure of the descendants of `source_node'. """
+        stack = [(source_node, destination_node)]
+        while stack:
+            source_node, destination_node = stack.pop()
+            children = []
+            for elt in self._iter_xml_structure_children(source_node):
+                elt = XMLElement(elt)
+                new_destination_node = elt.to_xml_structure_element()
+                destination_node.append(new_destination_node)
+                new_source_node = self._get_xml_structure_source_node(elt, stories, shared)
+                if new_source_node is not None:
+                    children.append((new_source_node, new_destination_node))
+            stack.extend(reversed(children))
+
+    def _iter_xml_structure_children(self, source_node):
+        """Yield the XMLElement of the children of `source_node' in the xml_structure, in the document order. """
+        # Explicit stack of tasks, in the order of the former recursive walk:
+        # - ("walk", elt, None): look for the children in the content of `elt';
+        # - ("yield", elt, parent_id): `elt' is a child unless it has the id of its parent.
+        stack = [("walk", source_node, None)]
+        while stack:
+            task, elt, parent_id = stack.pop()
+            if task == "walk":
+                source_id = elt.get("Self")
+                tasks = []
+                for child in elt.iterchildren():
+                    if not child.tag == "XMLElement":
+                        tasks.append(("walk", child, None))
+                    tasks.append(("yield", child, source_id))
+                stack.extend(reversed(tasks))
+            elif elt.get("Self") != parent_id and elt.get("MarkupTag"):
+                yield elt
+
+    def _get_xml_structure_source_node(self, elt, stories=None, shared=False):
+        """Return the node holding the children of the XMLElement `elt', in its own story if it has one. """
+        if not elt.get("XMLContent"):
+            return elt
+        story_name = "%s/Story_%s.xml" % (STORIES_DIRNAME, elt.get("XMLContent"))
+        story = (stories or {}).pop(story_name, None) or self.get_idml_xml_file(story_name, shared=shared)
+        try:
+            return story.get_element_by_id(elt.get("Self"))
+        # The story does not exists.
+        except (KeyError, IOError):
+            return None
+
+    @property
+    def xml_structure_cache_key(self):
+        """Hash of the members the xml_structure is discovered from. None if the package is edited. """
+        if self.working_copy is not None:
+            return None
+        key = hashlib.sha1(XML_STRUCTURE_CACHE_VERSION)
+        for info in self.infolist():
+            if info.filename == BACKINGSTORY or info.filename.startswith("%s/" % STORIES_DIRNAME):
+                key.update("%s:%d:%d\n" % (info.filename.encode("utf-8"), info.CRC, info.file_size))
+        return key.hexdigest()
+
+    def _get_xml_structure_cache_filename(self):
+        if not self.xml_structure_cache_dir:
+            return None
+        key = self.xml_structure_cache_key
+        return key and os.path.join(self.xml_structure_cache_dir, "%s.xml" % key) or None
+
+    def _get_cached_xml_structure(self):
+        filename = self._get_xml_structure_cache_filename()
+        if filename is None or not os.path.exists(filename):
+            return None
+        try:
+            return etree.parse(filename).getroot()
+        # A broken cache file is ignored (and replaced).
+        except etree.XMLSyntaxError:
+            return None
+
+    def _cache_xml_structure(self, structure):
+        filename = self._get_xml_structure_cache_filename()
+        if filename is None:
+            return
+        if not os.path.exists(self.xml_structure_cache_dir):
+            os.makedirs(self.xml_structure_cache_dir)
+        # Written aside and renamed so a concurrent reader never get a partial file.
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp_filename, "wb") as fobj:
+            fobj.write(etree.tostring(structure, encoding="UTF-8", xml_declaration=True))
+        os.rename(tmp_filename, filename)
+
     def xml_structure_pretty(self):
         return etree.tostring(self.xml_structure, pretty_print=True)
 
@@ -123,7 +266,7 @@ class IDMLPackage(zipfile.ZipFile):
     @property
     def designmap(self):
         if self._designmap is None:
-            designmap = Designmap(self, working_copy_path=self.working_copy_path)
+            designmap = self.get_idml_xml_file(Designmap.name)
             self._designmap = designmap
         return self._designmap
 
@@ -151,7 +294,7 @@ class IDMLPackage(zipfile.ZipFile):
     @property
     def style(self):
         if self._style is None:
-            style = Style(self, self.working_copy_path)
+            style = self.get_idml_xml_file(Style.name)
             self._style = style
         return self._style
 
@@ -159,14 +302,14 @@ class IDMLPackage(zipfile.ZipFile):
     def style_mapping(self):
         """The style mapping file may not be present in the archive and is created in that case. """
         if self._style_mapping is None:
-            style_mapping = StyleMapping(self, self.working_copy_path)
+            style_mapping = self.get_idml_xml_file(StyleMapping.name)
             self._style_mapping = style_mapping
         return self._style_mapping
 
     @property
     def graphic(self):
         if self._graphic is None:
-            graphic = Graphic(self, self.working_copy_path)
+            graphic = self.get_idml_xml_file(Graphic.name)
             self._graphic = graphic
         return self._graphic
 
@@ -180,10 +323,27 @@ class IDMLPackage(zipfile.ZipFile):
     @property
     def spreads_objects(self):
         if self._spreads_objects is None:
-            spreads_objects = [Spread(self, s, self.working_copy_path) for s in self.spreads]
+            spreads_objects = [self.get_idml_xml_file(s) for s in self.spreads]
             self._spreads_objects = spreads_objects
         return self._spreads_objects
 
+    @property
+    def spread_locator(self):
+        """{id: (spread, element)} of the spread elements by their `Self' or `ParentStory' value.
+
+        It is built in one pass over the spreads the first time an element is located.
+        """
+        if self._spread_locator is None:
+            spread_locator = {}
+            for spread in self.spreads_objects:
+                # A `Self' match wins over a `ParentStory' one, the first spread wins over the next ones.
+                for attr in ("Self", "ParentStory"):
+                    for (index_attr, value), elements in spread.index.items():
+                        if index_attr == attr and elements:
+                            spread_locator.setdefault(value, (spread, elements[0]))
+            self._spread_locator = spread_locator
+        return self._spread_locator
+
     @property
     def pages(self):
         if self._pages is None:
@@ -197,7 +357,7 @@ class IDMLPackage(zipfile.ZipFile):
     def backing_story(self):
         """The style mapping file may not be present in the archive and is created in that case. """
         if self._backing_story is None:
-            backing_story = BackingStory(self, working_copy_path=self.working_copy_path)
+            backing_story = self.get_idml_xml_file(BACKINGSTORY)
             self._backing_story = backing_story
         return self._backing_story
 
@@ -230,46 +390,91 @@ class IDMLPackage(zipfile.ZipFile):
 
     @property
     def referenced_layers(self):
+        """The layers having page items, in the designmap order. """
         if self._referenced_layers is None:
-            referenced_layers = []
-            for layer in self.designmap.layer_nodes:
-                layer_id = layer.get("Self")
-                for spread in self.spreads_objects:
-                    if spread.has_any_item_on_layer(layer_id):
-                        referenced_layers.append(layer_id)
+            layers_with_items = set()
+            for spread in self.spreads_objects:
+                layers_with_items.update(spread.layer_items_count)
+            referenced_layers = [layer.get("Self") for layer in self.designmap.layer_nodes
+                                 if layer.get("Self") in layers_with_items]
             self._referenced_layers = referenced_layers
         return self._referenced_layers
 
+    def compile_import_plan(self, at):
+        """Precompute the lookups of `import_xml(xml, at)' to run it on copies of this package. """
+        return ImportPlan(self, at)
+
     @use_working_copy
-    def import_xml(self, xml, at):
-        """ Reproduce the action «Import XML» on a XML Element in InDesign® Structure. """
+    def import_xml(self, xml, at, plan=None):
+        """ Reproduce the action «Import XML» on a XML Element in InDesign® Structure.
+
+        The stories and spreads are modified in memory and written once at the end.
+        `plan' is an ImportPlan compiled on this package or on the template it is copied from.
+        """
 
         source_node = etree.fromstring(xml)
+        if plan is not None and at not in plan.nodes:
+            raise ValueError(u"The import plan was not compiled for the path '%s'." % at)
+
+        def _get_story(xpath):
+            if plan is not None:
+                return self.get_idml_xml_file(plan.nodes[xpath]["story"])
+            return self.get_story_object_by_xpath(xpath)
+
+        def _get_spread(xpath):
+            if plan is not None:
+                spread_name = plan.nodes[xpath]["spread"]
+                return spread_name and self.get_idml_xml_file(spread_name) or None
+            return self.get_spread_object_by_xpath(xpath)
+
+        def _get_element_id(xpath):
+            if plan is not None:
+                return plan.nodes[xpath]["element_id"]
+            return self.xml_structure.xpath(xpath)[0].get("Self")
+
+        def _get_element_content_id(xpath):
+            if plan is not None:
+                return plan.nodes[xpath]["element_content_id"]
+            return self.get_element_content_id_by_xpath(xpath)
+
+        def _get_children(xpath):
+            """[(tag, xpath), ...] of the children of the xml_structure node. """
+            if plan is not None:
+                return plan.nodes[xpath]["children"]
+            return [(c.tag, self.xml_structure_tree.getpath(c))
+                    for c in self.xml_structure.xpath(xpath)[0].iterchildren()]
+
+        def _get_character_style_mapping():
+            if plan is not None:
+                return plan.character_style_mapping
+            return self.style_mapping.character_style_mapping
+
+        def _get_style_node(style_name):
+            if plan is not None:
+                return plan.style_nodes[style_name]
+            return self.style.get_style_node_by_name(style_name)
 
         def _set_content(xpath, element_id, content, story=None):
-            story = story or self.get_story_object_by_xpath(xpath)
+            story = story or _get_story(xpath)
             story.set_element_content(element_id, content)
-            story.synchronize()
 
         def _set_attributes(xpath, element_id, items):
-            story = self.get_story_object_by_xpath(xpath)
+            story = _get_story(xpath)
             story.set_element_attributes(element_id, items)
             # Image references must be updated in the page item in Spread or Story.
             if "href" in items:
                 resource_path = items.get("href")
-                element_content_id = self.get_element_content_id_by_xpath(xpath)
-                spread = self.get_spread_object_by_xpath(xpath)
+                element_content_id = _get_element_content_id(xpath)
+                spread = _get_spread(xpath)
                 if resource_path == "":
                     story.remove_xml_element_page_items(element_id)
                     if spread:
-                        spread.remove_page_item(element_content_id, synchronize=True)
+                        spread.remove_page_item(element_content_id)
+                        self.relocate_spread_element(element_content_id)
                 else:
                     story.set_element_resource_path(element_content_id, resource_path)
                     if spread:
-                        spread.set_element_resource_path(element_content_id,
-                                                         resource_path,
-                                                         synchronize=True)
-            story.synchronize()
+                        spread.set_element_resource_path(element_content_id, resource_path)
 
         def _apply_style(style_range_node, style_to_apply_node, applied_style_node):
             """ A style_range_node as an applied_style_node overriden with style_to_apply_node. """
@@ -309,20 +514,24 @@ class IDMLPackage(zipfile.ZipFile):
             parent = mergeable_font_styles.get(applied_font_style, {})
             return parent.get(font_style_to_apply, font_style_to_apply)
 
-        def _get_nested_style_range_node(xml_structure_node):
+        def _get_nested_style_range_node(tags):
             """Use the more distant parent as base style and then apply its children styles until the new tag itself.
 
+            `tags' are the tags of the xml_structure nodes from the root to the new tag.
+
             Returns:
              o new_style_range_node: unbound element.
              o root_style_node
             """
+            if plan is not None and tags in plan.style_ranges:
+                new_style_range_node, root_style_node = plan.style_ranges[tags]
+                return copy.deepcopy(new_style_range_node), root_style_node
+
             nested_styles = []
-            while(xml_structure_node is not None):
-                style_name = self.style_mapping.character_style_mapping.get(xml_structure_node.tag)
+            for tag in tags:
+                style_name = _get_character_style_mapping().get(tag)
                 if style_name:
-                    style_node = self.style.get_style_node_by_name(style_name)
-                    nested_styles.insert(0, style_node)
-                xml_structure_node = xml_structure_node.getparent()
+                    nested_styles.append(_get_style_node(style_name))
 
             # Merge the styles starting from the top parent like in a HTML document.
             root_style_node = nested_styles.pop(0)
@@ -331,6 +540,8 @@ class IDMLPackage(zipfile.ZipFile):
             for style_to_apply_node in nested_styles:
                 _apply_style(new_style_range_node, style_to_apply_node, root_style_node)
 
+            if plan is not None:
+                plan.style_ranges[tags] = (copy.deepcopy(new_style_range_node), root_style_node)
             return new_style_range_node, root_style_node
 
         def _apply_parent_style_range(style_range_node, applied_style_node, parent):
@@ -356,7 +567,7 @@ class IDMLPackage(zipfile.ZipFile):
             """ When new XML elements are inserted, the siblings of the initial <content> (<BR> etc) are
                 repositionned after the last <content> created.
             """
-            story = self.get_story_object_by_xpath(at)
+            story = _get_story(at)
             element = story.get_element_by_id(element_id)
             content_nodes = element.get_element_content_nodes()
             if len(content_nodes) < 2:
@@ -370,16 +581,22 @@ class IDMLPackage(zipfile.ZipFile):
 
             for sibling in siblings:
                 last_content_node.addnext(sibling)
-            story.synchronize()
-
-        def _import_new_node(source_node, at=None, element_id=None, story=None):
-            xml_structure_parent_node = self.xml_structure.find("*//*[@Self='%s']" % element_id)
-            xml_structure_new_node = etree.Element(source_node.tag)
-            # We cannot force the self._xml_structure reset by setting it at None.
-            xml_structure_parent_node.append(xml_structure_new_node)
+            story.set_dirty()
+
+        def _import_new_node(source_node, at=None, element_id=None, story=None, parent_tags=None):
+            if plan is None:
+                xml_structure_parent_node = self.xml_structure.find("*//*[@Self='%s']" % element_id)
+                xml_structure_new_node = etree.Element(source_node.tag)
+                # We cannot force the self._xml_structure reset by setting it at None.
+                xml_structure_parent_node.append(xml_structure_new_node)
+                tags = tuple([n.tag for n in reversed(list(xml_structure_new_node.iterancestors()))] +
+                             [source_node.tag])
+            # The xml_structure is not used with a plan: it is reset at the end of the import.
+            else:
+                tags = (parent_tags or plan.nodes[at]["tags"]) + (source_node.tag,)
 
-            style_range_node, applied_style_node = _get_nested_style_range_node(xml_structure_new_node)
-            story = story or self.get_story_object_by_xpath(at)
+            style_range_node, applied_style_node = _get_nested_style_range_node(tags)
+            story = story or _get_story(at)
             parent = story.get_element_by_id(element_id)
             _apply_parent_style_range(style_range_node, applied_style_node, parent)
 
@@ -387,23 +604,23 @@ class IDMLPackage(zipfile.ZipFile):
             new_xml_element.add_content(source_node.text, parent, style_range_node)
             story.add_element(element_id, new_xml_element.element)
 
-            xml_structure_new_node.set("Self", new_xml_element.get("Self"))
+            if plan is None:
+                xml_structure_new_node.set("Self", new_xml_element.get("Self"))
 
             # Source may also contains some children.
             source_node_children = source_node.getchildren()
             if len(source_node_children):
-                story.synchronize()
                 for j, source_node_child in enumerate(source_node_children):
                     _import_new_node(source_node_child,
                                      element_id=new_xml_element.get("Self"),
-                                     story=story)
+                                     story=story,
+                                     parent_tags=tags)
 
             if source_node.tail:
                 story.add_content_to_element(element_id, source_node.tail, parent)
-            story.synchronize()
 
         def _import_node(source_node, at=None, element_id=None, story=None, ignorecontent_parent_flag=False):
-            element_id = element_id or self.xml_structure.xpath(at)[0].get("Self")
+            element_id = element_id or _get_element_id(at)
             items = dict(source_node.items())
 
             forcecontent = (items.get(FORCECONTENT_TAG) == "true")
@@ -417,123 +634,250 @@ class IDMLPackage(zipfile.ZipFile):
             source_node_children = source_node.getchildren()
             if len(source_node_children):
                 source_node_children_tags = [n.tag for n in source_node_children]
-                destination_node = self.xml_structure.xpath(at)[0]
-                destination_node_children = destination_node.iterchildren()
-                destination_node_children_tags = [n.tag for n in destination_node.iterchildren()]
+                destination_node_children = _get_children(at)
+                destination_node_children_tags = [tag for tag, xpath in destination_node_children]
                 # Childrens in source node (xml file) and destination node are an exact match,
                 # we can call a map() on _import_node().
                 # FIXME: what if source_node.text exists ?
                 if destination_node_children_tags == source_node_children_tags:
-                    map(lambda s, d: _import_node(s, at=d, ignorecontent_parent_flag=ignorecontent),
-                        source_node_children, [self.xml_structure_tree.getpath(c) for c in destination_node.iterchildren()])
+                    map(lambda s, d: _import_node(s, at=d[1], ignorecontent_parent_flag=ignorecontent),
+                        source_node_children, destination_node_children)
                 # Step-by-step iteration.
                 else:
+                    destination_node_children = iter(destination_node_children)
                     destination_node_child = next(destination_node_children, None)
                     for i, source_child in enumerate(source_node_children):
                         # Source and destination match.
-                        if destination_node_child is not None and source_child.tag == destination_node_child.tag:
-                            _import_node(source_child, at=self.xml_structure_tree.getpath(destination_node_child),
+                        if destination_node_child is not None and source_child.tag == destination_node_child[0]:
+                            _import_node(source_child, at=destination_node_child[1],
                                          ignorecontent_parent_flag=ignorecontent)
                             destination_node_child = next(destination_node_children, None)
                         # Source does not match destination. It is added, but only if the tag is mapped to a style.
-                        elif not ignorecontent and source_child.tag in self.style_mapping.character_style_mapping.keys():
+                        elif not ignorecontent and source_child.tag in _get_character_style_mapping():
                             _import_new_node(source_child, at, element_id)
 
                     _move_siblings_content(at, element_id)
 
         _import_node(source_node, at)
+        self.synchronize_idml_xml_files()
+        if plan is not None:
+            self._xml_structure = None
+            self._xml_structure_tree = None
         return self
 
-    def export_as_tree(self):
-        """
+    def export_as_tree(self, from_tag=None):
+        """Return the content of the XML element `from_tag' (the root by default) as a tree.
+
         tree = {
             "tag": "Root",
             "attrs": {...},
             "content": ["foo", {subtree}, "bar", ...]
         }
         """
+        story_ids = set(self.story_ids)
+        xml_structure_root_node, story = self._get_export_root(from_tag)
+        tree = {"tag": xml_structure_root_node.tag, "attrs": {}, "content": []}
+
+        # Explicit stack: the story of a node is resolved from its parent's story.
+        stack = [(xml_structure_root_node, story, tree)]
+        while stack:
+            xml_structure_node, story, subtree = stack.pop()
+            attrs, content = self._get_export_content(xml_structure_node, story)
+            subtree["attrs"] = copy.deepcopy(attrs)
+            subtree["content"] = content
+            for i, c in enumerate(content):
+                if not isinstance(c, basestring):
+                    content[i] = {"tag": c.tag, "attrs": {}, "content": []}
+                    stack.append((c, self._get_export_story(c, story, story_ids), content[i]))
+        return tree
+
+    def _get_export_root(self, from_tag=None, shared=True):
+        """Return the `xml_structure' node matching the XPath `from_tag' (the root by default) and its story.
+
+        Only the stories of this node and of its ancestors are opened. When the xml_structure
+        is neither discovered nor cached, a path of tags and positions is resolved from these
+        stories (see `_discover_xml_structure_node()'). `shared' is passed to `_get_export_story()'.
+        """
+        story_ids = set(self.story_ids)
+        if self._xml_structure is None:
+            self._xml_structure = self._get_cached_xml_structure()
+        if self._xml_structure is None and from_tag and rx_xml_structure_path.match(from_tag):
+            return self._discover_xml_structure_node(from_tag, story_ids, shared)
 
-        def _export_content_as_tree(xml_structure_node):
-            content = []
-            tree = {"tag": xml_structure_node.tag,
-                    "attrs": {},
-                    "content": content}
-            # Explore the story to discover the content and the attributes.
-            xpath = self.xml_structure_tree.getpath(xml_structure_node)
-            story = self.get_story_object_by_xpath(xpath)
-
-            try:
-                story.fobj
-            except KeyError:
-                story_content_and_xmlelement_nodes = []
-            else:
-                story_node = story.get_element_by_id(xml_structure_node.get("Self"))
-                story_content_and_xmlelement_nodes = story.get_element_content_and_xmlelement_nodes(story_node)
-                # Attributes. TODO: Attributes are already known in xml_structure.
-                tree["attrs"] = copy.deepcopy(story_node.get_attributes())
-
-            xml_structure_node_children = xml_structure_node.getchildren()
-
-            if len(story_content_and_xmlelement_nodes):
-                # Leaf with content.
-                if len(xml_structure_node_children) == 0:
-                    content.append("".join([c.text or "" for c in story_content_and_xmlelement_nodes]))  # if not XMLElement
-                # Node with content.
-                else:
-                    xml_structure_child_node = xml_structure_node_children.pop(0)
-                    for story_content_node in story_content_and_xmlelement_nodes:
-                        if story_content_node.tag == "XMLElement":
-                            content.append(_export_content_as_tree(xml_structure_child_node))
-                            try:
-                                xml_structure_child_node = xml_structure_node_children.pop(0)
-                            except IndexError:
-                                xml_structure_child_node = None
-                        else:
-                            content.append(story_content_node.text)
+        if from_tag is None:
+            xml_structure_node = self.xml_structure
+        else:
+            xml_structure_node = self.xml_structure.xpath(from_tag)[0]
+        # The story is the one of the nearest node referencing a story, like in get_story_object_by_xpath().
+        for node in [xml_structure_node] + list(xml_structure_node.iterancestors()):
+            story = self._get_export_story(node, None, story_ids, shared)
+            if story is not None:
+                return xml_structure_node, story
+        return xml_structure_node, self.backing_story
+
+    def _discover_xml_structure_node(self, path, story_ids, shared=True):
+        """Return the node of `path' (/Root/module[1]/Story) with the xml_structure of its descendants, and its story.
+
+        The children of the ancestors are discovered from their stories only. IndexError is
+        raised if no node matches.
+        """
+        story = shared and self.backing_story or self.get_idml_xml_file(BACKINGSTORY, shared=False)
+        children = [story.get_root().element]
+        for tag, position in rx_xml_structure_step.findall(path):
+            children = [c for c in children if c.get("MarkupTag").replace("XMLTag/", "") == tag]
+            if len(children) < int(position or 1):
+                raise IndexError(u"No node matches the path '%s' in the xml_structure." % path)
+            elt = XMLElement(children[int(position or 1) - 1])
+            story = self._get_export_story(elt, story, story_ids, shared)
+            # The children are stored in the element's own story, if it has one.
+            if not elt.get("XMLContent"):
+                source_node = elt
+            elif elt.get("XMLContent") in story_ids:
+                source_node = story.get_element_by_id(elt.get("Self"))
             else:
-                # Node without content > `content' is fed with recursive call on childrens.
-                if len(xml_structure_node_children):
-                    content.extend(map(_export_content_as_tree, xml_structure_node_children))
+                source_node = None
+            children = source_node is not None and list(self._iter_xml_structure_children(source_node)) or []
 
-            return tree
+        xml_structure_node = elt.to_xml_structure_element()
+        if source_node is not None:
+            self._discover_xml_structure_children(source_node, xml_structure_node, shared=shared)
+        return xml_structure_node, story
 
-        xml_structure_root_node = self.xml_structure
-        return _export_content_as_tree(xml_structure_root_node)
+    def _get_export_story(self, xml_structure_node, parent_story, story_ids, shared=True):
+        """Return the story holding the content of `xml_structure_node'.
 
-    def export_xml(self, from_tag=None, encoding=None):
-        """ Reproduce the action «Export XML» on a XML Element in InDesign® Structure. """
-        tree = self.export_as_tree()
-        dom = tree_to_etree_dom(tree)
-        return etree.tostring(dom, encoding=encoding, pretty_print=True)
+        Some XMLElement store a reference which is not a Story: the content is then in
+        the parent's story. With `shared=False', a story not parsed yet is read in a
+        private instance which is released with the exported node.
+        """
+        ref = xml_structure_node.get("XMLContent")
+        if not ref or ref not in story_ids:
+            return parent_story
+        return self.get_idml_xml_file("%s/Story_%s.xml" % (STORIES_DIRNAME, ref), shared=shared)
+
+    def _get_export_content(self, xml_structure_node, story):
+        """Return the attributes and the content of `xml_structure_node' found in `story'.
+
+        The content is a list of strings and of `xml_structure' children nodes.
+        """
+        xml_structure_node_children = xml_structure_node.getchildren()
+        try:
+            story_node = story.get_element_by_id(xml_structure_node.get("Self"))
+        except (KeyError, IOError):
+            # Node without content > `content' is made of the children.
+            return {}, xml_structure_node_children
+
+        story_content_and_xmlelement_nodes = story.get_element_content_and_xmlelement_nodes(story_node)
+        # Attributes. TODO: Attributes are already known in xml_structure.
+        attrs = story_node.get_attributes()
+
+        if not len(story_content_and_xmlelement_nodes):
+            return attrs, xml_structure_node_children
+        # Leaf with content.
+        if len(xml_structure_node_children) == 0:
+            return attrs, ["".join([c.text or "" for c in story_content_and_xmlelement_nodes])]
+        # Node with content.
+        content = []
+        xml_structure_node_children = iter(xml_structure_node_children)
+        for story_content_node in story_content_and_xmlelement_nodes:
+            if story_content_node.tag == "XMLElement":
+                xml_structure_child_node = next(xml_structure_node_children, None)
+                if xml_structure_child_node is not None:
+                    content.append(xml_structure_child_node)
+            else:
+                content.append(story_content_node.text or "")
+        return attrs, content
+
+    def export_xml(self, from_tag=None, encoding=None, fileobj=None):
+        """ Reproduce the action «Export XML» on a XML Element in InDesign® Structure.
+
+        `from_tag' is the XPath of the exported element in `xml_structure' (the root by default):
+        only the stories reachable from this element are parsed.
+        If `fileobj' is given, the XML is written in it as the structure is walked
+        instead of being returned: only the stories of the current branch are kept in memory.
+        """
+        if fileobj is None:
+            tree = self.export_as_tree(from_tag)
+            dom = tree_to_etree_dom(tree)
+            return etree.tostring(dom, encoding=encoding, pretty_print=True)
+
+        story_ids = set(self.story_ids)
+        xml_structure_root_node, story = self._get_export_root(from_tag, shared=False)
+        if encoding and encoding.upper() not in ("UTF-8", "UTF8", "ASCII", "US-ASCII"):
+            fileobj.write("<?xml version='1.0' encoding='%s'?>\n" % encoding)
+
+        with etree.xmlfile(fileobj, encoding=encoding) as xf:
+            # Explicit stack of actions: write a node (whose story is resolved from its
+            # parent's story when it is written), write a text or close an element.
+            stack = [("node", (xml_structure_root_node, None, story, 0, True))]
+            while stack:
+                action, args = stack.pop()
+                if action == "text":
+                    xf.write(args)
+                    continue
+                if action == "close":
+                    args.__exit__(None, None, None)
+                    continue
+
+                xml_structure_node, parent_story, story, level, pretty_print = args
+                if story is None:
+                    story = self._get_export_story(xml_structure_node, parent_story, story_ids, shared=False)
+                attrs, content = self._get_export_content(xml_structure_node, story)
+                if not content:
+                    xf.write(etree.Element(xml_structure_node.tag, **attrs))
+                    continue
+                # Same indentation as `etree.tostring(pretty_print=True)': none in mixed content.
+                pretty_print = pretty_print and not any(isinstance(c, basestring) for c in content)
+                element = xf.element(xml_structure_node.tag, attrs)
+                element.__enter__()
+
+                actions = []
+                for c in content:
+                    if isinstance(c, basestring):
+                        actions.append(("text", c))
+                        continue
+                    if pretty_print:
+                        actions.append(("text", "\n" + "  " * (level + 1)))
+                    actions.append(("node", (c, story, None, level + 1, pretty_print)))
+                if pretty_print:
+                    actions.append(("text", "\n" + "  " * level))
+                actions.append(("close", element))
+                stack.extend(reversed(actions))
+        fileobj.write("\n")
 
     @use_working_copy
-    def prefix(self, prefix):
+    def prefix(self, prefix, workers=None):
         """Change references and filename by inserting `prefix' everywhere.
 
         files in ZipFile cannot be renamed or moved so we make a copies of them.
+        With `workers', the files are prefixed by a pool of processes.
         """
         if not re.match("^\w+$", prefix):
             raise BaseException("Prefix must be alphanumeric.")
+        if workers is None:
+            workers = self.prefix_workers
 
         # Change the references inside the file.
-        for filename in self.namelist():
-            if (
-                os.path.basename(filename) in ["container.xml", "metadata.xml"] or
-                os.path.splitext(filename)[1] != ".xml"
-            ):
-                continue
-            idml_xml_file = get_idml_xml_file_by_name(self, filename, self.working_copy_path)
-            idml_xml_file.prefix_references(prefix)
-            idml_xml_file.synchronize()
+        idml_xml_files = [get_idml_xml_file_by_name(self, filename, self.working_copy)
+                          for filename in self.namelist()
+                          if os.path.basename(filename) not in ["container.xml", "metadata.xml"] and
+                          os.path.splitext(filename)[1] == ".xml"]
+        if workers:
+            prefix_idml_xml_files(idml_xml_files, prefix, workers)
+        else:
+            for idml_xml_file in idml_xml_files:
+                idml_xml_file.prefix_references(prefix)
+                idml_xml_file.synchronize()
 
         # Story and Spread XML files are "prefixed".
         for filename in self.contentfile_namelist():
             new_basename = prefix_content_filename(os.path.basename(filename),
                                                    prefix, "filename")
             # mv file in the new archive with the prefix.
-            old_name = os.path.join(self.working_copy_path, filename)
-            new_name = os.path.join(os.path.dirname(old_name), new_basename)
-            os.rename(old_name, new_name)
+            new_name = "%s/%s" % (os.path.dirname(filename), new_basename)
+            self.working_copy.rename(filename, new_name)
+        self.invalidate_idml_xml_files()
+        self.init_lazy_references()
 
         # Update designmap.xml.
         self.designmap.prefix(prefix)
@@ -554,18 +898,28 @@ class IDMLPackage(zipfile.ZipFile):
 
     @use_working_copy
     def insert_idml(self, idml_package, at, only):
-        t = self._get_item_translation_for_insert(idml_package, at, only)
-        self.remove_content(at)
-        self._add_font_families_from_idml(idml_package)
-        self._add_styles_from_idml(idml_package)
-        self._add_mapped_styles_from_idml(idml_package)
-        self._add_graphics_from_idml(idml_package)
-        self._add_tags_from_idml(idml_package)
-        self._add_spread_elements_from_idml(idml_package, at, only, t)
-        self._add_stories_from_idml(idml_package, at, only)
-        self._add_layers_from_idml(idml_package, at, only)
+        return self.insert_idmls([(idml_package, at, only)])
+
+    @use_working_copy
+    def insert_idmls(self, idml_packages):
+        """Insert a list of (idml_package, at, only) in a single pass.
+
+        The resources shared by the insertions (fonts, styles, mapping, graphics, tags
+        and designmap) are merged in memory and written once, after the last package.
+        """
+        for idml_package, at, only in idml_packages:
+            t = self._get_item_translation_for_insert(idml_package, at, only)
+            self.remove_content(at)
+            self._add_font_families_from_idml(idml_package, synchronize=False)
+            self._add_styles_from_idml(idml_package, synchronize=False)
+            self._add_mapped_styles_from_idml(idml_package, synchronize=False)
+            self._add_graphics_from_idml(idml_package, synchronize=False)
+            self._add_tags_from_idml(idml_package, synchronize=False)
+            self._add_spread_elements_from_idml(idml_package, at, only, t)
+            self._add_stories_from_idml(idml_package, at, only, synchronize=False)
+            self._add_layers_from_idml(idml_package, at, only, synchronize=False)
         self.remove_orphan_layers()
-        self._xml_structure = None
+        self.synchronize_idml_xml_files()
         return self
 
     @use_working_copy
@@ -585,6 +939,7 @@ class IDMLPackage(zipfile.ZipFile):
             spread = self.get_spread_object_by_xpath(xpath)
             if spread:
                 spread.remove_page_item(element_content_id, synchronize=True)
+                self.relocate_spread_element(element_content_id)
 
         try:
             node = self.xml_structure.xpath(under)[0]
@@ -595,14 +950,17 @@ class IDMLPackage(zipfile.ZipFile):
         story = self.get_story_object_by_xpath(under)
         story.remove_children(node.get("Self"), synchronize=True)
 
-        self.init_lazy_references()
+        for child in node.getchildren():
+            node.remove(child)
+        self.init_lazy_references(xml_structure=False)
         return self
 
     @use_working_copy
     def remove_orphan_layers(self):
+        referenced_layers = set(self.referenced_layers)
         for layer in self.designmap.layer_nodes:
             layer_id = layer.get("Self")
-            if layer_id not in self.referenced_layers:
+            if layer_id not in referenced_layers:
                 self.remove_layer(layer_id)
         return self
 
@@ -615,62 +973,53 @@ class IDMLPackage(zipfile.ZipFile):
     @use_working_copy
     def remove_guides_on_layer(self, layer_id):
         for spread in self.spreads_objects:
-            if spread.has_any_guide_on_layer(layer_id):
-                spread.remove_guides_on_layer(layer_id, synchronize=True)
+            spread.remove_guides_on_layer(layer_id, synchronize=True)
         return self
 
-    def _add_font_families_from_idml(self, idml_package):
-        # TODO Optimization. There is a linear expansion of the Fonts.xml size
-        #      as packages are merged. Do something cleaver to prune or reuse
-        #      fonts already here.
-        fonts = Fonts(self)
-        fonts.working_copy_path = self.working_copy_path
-        fonts_root_elt = fonts.get_root()
+    def _add_font_families_from_idml(self, idml_package, synchronize=True):
+        """The font families already in Fonts.xml are completed rather than added again. """
+        fonts = self.get_idml_xml_file(Fonts.name)
         for font_family in idml_package.font_families:
-            fonts_root_elt.append(copy.deepcopy(font_family))
-        fonts.synchronize()
-
-    def _add_styles_from_idml(self, idml_package):
-        """Append styles to their groups or add the group in the Styles file. """
-        styles = Style(self)
-        styles.working_copy_path = self.working_copy_path
-        styles_root_elt = styles.get_root()
+            fonts.add_font_family(font_family)
+        if synchronize:
+            fonts.synchronize()
+
+    def _add_styles_from_idml(self, idml_package, synchronize=True):
+        """Add the styles missing in their groups, or the group, in the Styles file. """
+        styles = self.style
         for group_to_insert in idml_package.style_groups:
-            group_host = styles_root_elt.xpath(group_to_insert.tag)
-            # Either the group exists.
-            if group_host:
-                for style_to_insert in group_to_insert.iterchildren():
-                    group_host[0].append(copy.deepcopy(style_to_insert))
-            # or not.
-            else:
-                styles_root_elt.append(copy.deepcopy(group_to_insert))
-        styles.synchronize()
+            styles.add_style_group(group_to_insert)
+        if synchronize:
+            styles.synchronize()
 
-    def _add_mapped_styles_from_idml(self, idml_package):
+    def _add_mapped_styles_from_idml(self, idml_package, synchronize=True):
         if idml_package.style_mapping:
             for style_node in idml_package.style_mapping.iter_stylenode():
                 self.style_mapping.add_stylenode(style_node)
-            self.style_mapping.synchronize()
+            if synchronize:
+                self.style_mapping.synchronize()
 
         # Update designmap.xml because it may not reference the Mapping file.
         # if self Package does not have any style mapping.
         if self.designmap.style_mapping_node is None:
             self.designmap.set_style_mapping_node()
-            self.designmap.synchronize()
+            if synchronize:
+                self.designmap.synchronize()
 
-    def _add_graphics_from_idml(self, idml_package):
+    def _add_graphics_from_idml(self, idml_package, synchronize=True):
         for graphic_node in idml_package.graphic.dom.iterchildren():
-            self.graphic.dom.append(copy.deepcopy(graphic_node))
-        self.graphic.synchronize()
-
-    def _add_tags_from_idml(self, idml_package):
-        tags = Tags(self)
-        tags.working_copy_path = self.working_copy_path
-        tags_root_elt = tags.get_root()
-        for tag in idml_package.tags:
-            if not tags_root_elt.xpath("//XMLTag[@Self='%s']" % (tag.get("Self"))):
-                tags_root_elt.append(copy.deepcopy(tag))
-        tags.synchronize()
+            graphic_node = copy.deepcopy(graphic_node)
+            self.graphic.dom.append(graphic_node)
+            self.graphic.index_element(graphic_node)
+            self.graphic.set_dirty()
+        if synchronize:
+            self.graphic.synchronize()
+
+    def _add_tags_from_idml(self, idml_package, synchronize=True):
+        tags = self.get_idml_xml_file(Tags.name)
+        tags.add_tags(idml_package.tags)
+        if synchronize:
+            tags.synchronize()
 
     def _get_item_translation_for_insert(self, idml_package, at, only):
         """ Compute the ItemTransform shift to apply to the elements in idml_package to insert. """
@@ -694,17 +1043,13 @@ class IDMLPackage(zipfile.ZipFile):
 
     def apply_translation_to_element(self, element, translation):
         """ItemTransform is a space separated string of 6 numerical values forming the transform matrix. """
-        translation_x, translation_y = translation
-        item_transform = element.get("ItemTransform").split(" ")
-        item_transform[4] = str(Decimal(item_transform[4]) + translation_x)
-        item_transform[5] = str(Decimal(item_transform[5]) + translation_y)
-        element.set("ItemTransform", " ".join(item_transform))
+        get_geometry_engine(self.geometry_engine).translate([element], translation)
 
     def _add_spread_elements_from_idml(self, idml_package, at, only, translation):
         """ Append idml_package spread elements into self.spread[0] <Spread> node. """
 
         spread_dest_filename = self.get_spread_by_xpath(at)
-        spread_dest = Spread(self, spread_dest_filename, self.working_copy_path)
+        spread_dest = self.get_idml_xml_file(spread_dest_filename)
         spread_dest_elt = spread_dest.dom.xpath("./Spread")[0]
 
         only_node = idml_package.xml_structure.xpath(only)[0]
@@ -726,17 +1071,18 @@ class IDMLPackage(zipfile.ZipFile):
             if spread_elt not in spread_elts_to_add:
                 spread_elts_to_add.append(spread_elt)
 
-        def _add_spread_element(spread_dest_elt, spread_elt):
-            spread_elt_copy = copy.deepcopy(spread_elt)
-            self.apply_translation_to_element(spread_elt_copy, translation)
+        # The copies are translated at once.
+        spread_elts_copies = [copy.deepcopy(spread_elt) for spread_elt in spread_elts_to_add]
+        get_geometry_engine(self.geometry_engine).translate(spread_elts_copies, translation)
+        for spread_elt_copy in spread_elts_copies:
             spread_dest_elt.append(spread_elt_copy)
+            spread_dest.index_element(spread_elt_copy)
 
-        map(lambda s: _add_spread_element(spread_dest_elt, s), spread_elts_to_add)
-
+        spread_dest.set_dirty()
         spread_dest.synchronize()
-        self.init_lazy_references()
+        self.init_lazy_references(xml_structure=False)
 
-    def _add_stories_from_idml(self, idml_package, at, only):
+    def _add_stories_from_idml(self, idml_package, at, only, synchronize=True):
         """Add all idml_package stories and insert `only' refence at `at' position in self.
 
         What we have:
@@ -773,9 +1119,10 @@ class IDMLPackage(zipfile.ZipFile):
 
         """
 
-        xml_element_src_id = idml_package.xml_structure.xpath(only)[0].get("Self")
+        xml_structure_src_node = idml_package.xml_structure.xpath(only)[0]
+        xml_element_src_id = xml_structure_src_node.get("Self")
         story_src_filename = idml_package.get_story_by_xpath(only)
-        story_src = Story(idml_package, story_src_filename)
+        story_src = idml_package.get_idml_xml_file(story_src_filename)
         story_src_elt = story_src.get_element_by_id(xml_element_src_id).element
 
         xml_element_dest = self.xml_structure.xpath(at)[0]
@@ -791,7 +1138,7 @@ class IDMLPackage(zipfile.ZipFile):
             xml_element_dest = self.xml_structure.xpath(at)[0]
 
         story_dest_filename = self.get_story_by_xpath(at)
-        story_dest = Story(self, story_dest_filename, self.working_copy_path)
+        story_dest = self.get_idml_xml_file(story_dest_filename)
         story_dest_elt = story_dest.get_element_by_id(xml_element_dest_id)
 
         story_src_elt_copy = copy.copy(story_src_elt)
@@ -799,27 +1146,32 @@ class IDMLPackage(zipfile.ZipFile):
             for child in story_src_elt_copy.iterchildren():
                 story_src_elt_copy.remove(child)
         story_dest_elt.append(story_src_elt_copy)
+        story_dest.index_element(story_src_elt_copy)
+        story_dest.set_dirty()
         story_dest.synchronize()
 
+        # The copied stories hold the same structure than in idml_package.
+        xml_element_dest.append(copy.deepcopy(xml_structure_src_node))
+
         # Add Story files.
-        # `Stories' directory may not be present in the destination package.
-        stories_dirname = os.path.join(self.working_copy_path, STORIES_DIRNAME)
-        if not os.path.exists(stories_dirname):
-            os.mkdir(stories_dirname)
-        for filename in idml_package.stories_for_node(only):
-            story_cp = open(os.path.join(self.working_copy_path, filename), mode="w+")
+        stories = idml_package.stories_for_node(only)
+        for filename in stories:
+            story_cp = self.working_copy.open(filename, mode="w+")
             story_cp.write(idml_package.open(filename, mode="r").read())
             story_cp.close()
+        self.invalidate_idml_xml_files(stories)
 
         # Update designmap.xml.
         self.designmap.add_stories(idml_package.story_ids_for_node(only))
-        self.designmap.synchronize()
+        if synchronize:
+            self.designmap.synchronize()
         # BackingStory.xml ??
-        self.init_lazy_references()
+        self.init_lazy_references(xml_structure=False)
 
-    def _add_layers_from_idml(self, idml_package, at, only):
+    def _add_layers_from_idml(self, idml_package, at, only, synchronize=True):
         self.designmap.add_layer_nodes(idml_package.designmap.layer_nodes)
-        self.designmap.synchronize()
+        if synchronize:
+            self.designmap.synchronize()
 
     @use_working_copy
     def add_pages_from_idml(self, idml_packages):
@@ -831,11 +1183,11 @@ class IDMLPackage(zipfile.ZipFile):
     def add_page_from_idml(self, idml_package, page_number, at, only):
         last_spread = self.spreads_objects[-1]
         if last_spread.pages[-1].is_recto:
-            last_spread = self.add_new_spread(self.working_copy_path)
+            last_spread = self.add_new_spread(self.working_copy)
 
         page = idml_package.pages[page_number - 1]
         last_spread.add_page(page)
-        self.init_lazy_references()
+        self.init_lazy_references(xml_structure=False)
         last_spread.synchronize()
 
         self._add_stories_from_idml(idml_package, at, only)
@@ -847,10 +1199,11 @@ class IDMLPackage(zipfile.ZipFile):
 
     @use_working_copy
     def add_story_with_content(self, story_id, xml_element_id, xml_element_tag):
-        Story.create(self, story_id, xml_element_id, xml_element_tag, self.working_copy_path)
+        Story.create(self, story_id, xml_element_id, xml_element_tag, self.working_copy)
+        self.invalidate_idml_xml_files(["%s/Story_%s.xml" % (STORIES_DIRNAME, story_id)])
         self.designmap.add_stories([story_id])
         self.designmap.synchronize()
-        self.init_lazy_references()
+        self.init_lazy_references(xml_structure=False)
         return self
 
     @use_working_copy
@@ -871,31 +1224,33 @@ class IDMLPackage(zipfile.ZipFile):
 
         page_item.set("ParentStory", xml_content_ref)
         page_item.set("Self", "%sToNode" % xml_content_ref)
+        spread.index_element(page_item)
 
         # To be a node, a Rectangle must be converted into a TextFrame.
         # There is not simple way to change the tag of a XMLElement so
         # a new copy is created.
         if page_item.tag == "Rectangle":
             spread.rectangle_to_textframe(page_item)
+        self.relocate_spread_element(xml_content_ref)
+        spread.set_dirty()
         spread.synchronize()
         return self
 
-    def add_new_spread(self, working_copy_path):
+    def add_new_spread(self, working_copy):
         """Create a new empty Spread in the working copy from the last one. """
 
         last_spread = self.spreads_objects[-1]
         # TODO : make sure the filename does not exists.
         new_spread_name = increment_filename(last_spread.name)
-        new_spread_wc_path = os.path.join(working_copy_path, new_spread_name)
-        shutil.copy2(
-            os.path.join(working_copy_path, last_spread.name),
-            new_spread_wc_path
-        )
+        working_copy.copy(last_spread.name, new_spread_name)
+        self.invalidate_idml_xml_files([new_spread_name])
         self._spreads_objects = None
+        self._spread_locator = None
 
-        new_spread = Spread(self, new_spread_name, working_copy_path)
+        new_spread = self.get_idml_xml_file(new_spread_name)
         new_spread.clear()
         new_spread.node.set("Self", new_spread.get_node_name_from_xml_name())
+        new_spread.index_element(new_spread.node)
 
         self.designmap.add_spread(new_spread)
         self.designmap.synchronize()
@@ -928,34 +1283,47 @@ class IDMLPackage(zipfile.ZipFile):
 
         Spread element matches Story one with the ParentStory or the Self attribute value."""
 
-        result = None
-        for spread in self.spreads_objects:
-            if (
-                spread.get_element_by_id(elt_id, tag="*") is not None or
-                spread.get_element_by_id(elt_id, tag="*", attr="ParentStory") is not None
-            ):
-                result = spread
-            # FIXME: That's ugly. return spread here ?
-            if result:
-                break
-        return result
+        location = self.locate_spread_element(elt_id)
+        return location and location[0] or None
 
     def get_spread_elem_by_xpath(self, xpath):
         """Return the spread etree.Element matching the xml_structure's xpath. """
-        spread = self.get_spread_object_by_xpath(xpath)
         elt_id = self.xml_structure.xpath(xpath)[0].get("XMLContent")
-        elt = spread.get_element_by_id(elt_id, tag="*")
-        if elt is None:
-            elt = spread.get_element_by_id(elt_id, tag="*", attr="ParentStory")
-        return elt
+        return self.get_spread_elem_by_id(elt_id)
 
     def get_spread_elem_by_id(self, elt_id):
         """Return the spread etree.Element designed by XMLContent value. """
-        spread = self.get_spread_object_by_id(elt_id)
-        elt = spread.get_element_by_id(elt_id, tag="*")
-        if elt is None:
-            elt = spread.get_element_by_id(elt_id, tag="*", attr="ParentStory")
-        return elt
+        return self.locate_spread_element(elt_id)[1]
+
+    def locate_spread_element(self, elt_id):
+        """Return (spread, element) matching elt_id in `spread_locator' or None. """
+        location = self.spread_locator.get(elt_id)
+        if location is not None:
+            spread, elt = location
+            # The element may have been modified or removed since the locator was built.
+            if elt_id not in (elt.get("Self"), elt.get("ParentStory")) or not spread._is_in_dom(elt):
+                location = self.relocate_spread_element(elt_id)
+        return location
+
+    def relocate_spread_element(self, elt_id):
+        """Update `spread_locator' after the spread element matching elt_id is removed or replaced. """
+        if self._spread_locator is None:
+            return None
+        location = self._find_spread_element(elt_id)
+        if location is None:
+            self._spread_locator.pop(elt_id, None)
+        else:
+            self._spread_locator[elt_id] = location
+        return location
+
+    def _find_spread_element(self, elt_id):
+        for spread in self.spreads_objects:
+            elt = spread.get_element_by_id(elt_id, tag="*")
+            if elt is None:
+                elt = spread.get_element_by_id(elt_id, tag="*", attr="ParentStory")
+            if elt is not None:
+                return spread, elt
+        return None
 
     def get_spread_by_xpath(self, xpath):
         spread = self.get_spread_object_by_xpath(xpath)
@@ -998,10 +1366,9 @@ class IDMLPackage(zipfile.ZipFile):
             story = self.get_story_object_by_xpath(xpath)
         else:
             if story_name == BACKINGSTORY:
-                story = BackingStory(self)
+                story = self.backing_story
             else:
-                story = Story(self, "%s/Story_%s.xml" % (STORIES_DIRNAME, story_name))
-        story.working_copy_path = self.working_copy_path
+                story = self.get_idml_xml_file("%s/Story_%s.xml" % (STORIES_DIRNAME, story_name))
         return story
 
     def get_story_by_xpath(self, xpath):
@@ -1019,3 +1386,79 @@ class IDMLPackage(zipfile.ZipFile):
     def get_elem_translation(self, elem):
         item_transform = elem.get("ItemTransform").split(" ")
         return Decimal(item_transform[4]), Decimal(item_transform[5])
+
+
+class ImportPlan(object):
+    """The lookups of `IDMLPackage.import_xml()' computed once on a template.
+
+    The packages copied from a template share its stories and XML elements ids,
+    so the xml_structure of the template is only explored when the plan is compiled:
+
+        plan = template.compile_import_plan("/Root/module[1]")
+        for xml in payloads:
+            ...
+            idml_package.import_xml(xml, at="/Root/module[1]", plan=plan)
+
+    `nodes' maps the xpath of `at' and of its descendants in the xml_structure to:
+     o tags: the tags from the root to the node.
+     o element_id, element_content_id: the `Self' and `XMLContent' values.
+     o story, spread: the names of the files storing the XMLElement and its page item.
+     o children: [(tag, xpath), ...]
+    """
+
+    def __init__(self, idml_package, at):
+        self.at = at
+        self.nodes = {}
+        self.character_style_mapping = dict(idml_package.style_mapping.character_style_mapping)
+        self.style_nodes = {}
+        for style_name in set(self.character_style_mapping.values()):
+            try:
+                style_node = idml_package.style.get_style_node_by_name(style_name)
+            except IndexError:
+                continue
+            self.style_nodes[style_name] = copy.deepcopy(style_node)
+        # The new tags style ranges, by `tags', are computed on demand.
+        self.style_ranges = {}
+        self._compile(idml_package)
+
+    def __getstate__(self):
+        # The plan is sent to the render workers: the style nodes are pickled serialized.
+        state = dict(self.__dict__)
+        state["style_nodes"] = dict([(name, etree.tostring(node))
+                                     for name, node in self.style_nodes.items()])
+        state["style_ranges"] = {}
+        return state
+
+    def __setstate__(self, state):
+        state["style_nodes"] = dict([(name, etree.fromstring(node))
+                                     for name, node in state["style_nodes"].items()])
+        self.__dict__.update(state)
+
+    def _compile(self, idml_package):
+        xml_structure_tree = idml_package.xml_structure_tree
+        story_ids = idml_package.story_ids
+        at_node = idml_package.xml_structure.xpath(self.at)[0]
+        at_tags = tuple([n.tag for n in reversed(list(at_node.iterancestors()))])
+
+        # The stories are resolved from the parents like in get_story_object_by_xpath().
+        stack = [(at_node, at_tags, idml_package.get_story_by_xpath(self.at))]
+        while stack:
+            node, parent_tags, parent_story = stack.pop()
+            element_content_id = node.get("XMLContent")
+            if element_content_id in story_ids:
+                story = "%s/Story_%s.xml" % (STORIES_DIRNAME, element_content_id)
+            else:
+                story = parent_story
+            spread = idml_package.get_spread_object_by_id(element_content_id)
+            tags = parent_tags + (node.tag,)
+            children = list(node.iterchildren())
+            self.nodes[xml_structure_tree.getpath(node)] = {
+                "tags": tags,
+                "element_id": node.get("Self"),
+                "element_content_id": element_content_id,
+                "story": story,
+                "spread": spread and spread.name or None,
+                "children": [(c.tag, xml_structure_tree.getpath(c)) for c in children],
+            }
+            stack.extend([(c, tags, story) for c in children])
+        self.nodes[self.at] = self.nodes[xml_structure_tree.getpath(at_node)]
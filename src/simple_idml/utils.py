@@ -4,6 +4,8 @@ import copy
 import new
 import os
 import re
+import struct
+import zipfile
 from lxml import etree
 from types import MethodType
 
@@ -92,21 +94,19 @@ def tree_to_etree_dom(tree):
 
     """
 
-    def _set_node_content(node, tree):
-        for c in tree["content"]:
+    dom = etree.Element(tree["tag"], **tree.get("attrs", {}))
+    stack = [(dom, tree)]
+    while stack:
+        node, subtree = stack.pop()
+        for c in subtree["content"]:
             if isinstance(c, dict):
                 child = etree.Element(c["tag"], **c.get("attrs", {}))
-                _set_node_content(child, c)
                 node.append(child)
+                stack.append((child, c))
+            elif len(node) == 0:
+                node.text = "%s%s" % (node.text or "", c or "")
             else:
-                node_children = node.getchildren()
-                if len(node_children) == 0:
-                    node.text = "%s%s" % (node.text or "", c or "")
-                else:
-                    node_children[-1].tail = "%s%s" % (node_children[-1].tail or "", c or "")
-
-    dom = etree.Element(tree["tag"], **tree.get("attrs", {}))
-    _set_node_content(dom, tree)
+                node[-1].tail = "%s%s" % (node[-1].tail or "", c or "")
 
     return dom
 
@@ -127,3 +127,42 @@ def deepcopy_element_as(element, tag):
     for child in element.iterchildren():
         new_element.append(copy.deepcopy(child))
     return new_element
+
+
+def get_document_position(element):
+    """The indexes of `element' and of its ancestors in their parent, from the root.
+
+    The positions of the elements of a tree are sorted in the document order.
+    """
+    position = []
+    parent = element.getparent()
+    while parent is not None:
+        position.append(parent.index(element))
+        element, parent = parent, parent.getparent()
+    position.reverse()
+    return position
+
+
+def copy_zip_member(source, destination, zinfo, arcname=None):
+    """Copy a member of the `source' ZipFile in `destination' without decompressing it.
+
+    zipfile has no access to the raw compressed data: the local header of the
+    member is skipped and the data is written after a header of the same ZipInfo,
+    like `ZipFile.write()' does.
+    """
+    source.fp.seek(zinfo.header_offset)
+    fheader = struct.unpack(zipfile.structFileHeader, source.fp.read(zipfile.sizeFileHeader))
+    source.fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+    data = source.fp.read(zinfo.compress_size)
+
+    new_zinfo = copy.copy(zinfo)
+    new_zinfo.filename = arcname or zinfo.filename
+    # The sizes and CRC are written in the header, not in a data descriptor.
+    new_zinfo.flag_bits &= ~0x08
+    new_zinfo.header_offset = destination.fp.tell()
+    destination._writecheck(new_zinfo)
+    destination._didModify = True
+    destination.fp.write(new_zinfo.FileHeader())
+    destination.fp.write(data)
+    destination.filelist.append(new_zinfo)
+    destination.NameToInfo[new_zinfo.filename] = new_zinfo
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import shutil
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile, mkstemp
+from simple_idml.utils import copy_zip_member
+
+
+class WorkingCopy(object):
+    """Abstract storage of the members of an IDMLPackage while it is modified.
+
+    An IDMLPackage (a ZipFile) cannot be modified in place so the methods decorated
+    with `use_working_copy' work on a copy of its members that is repacked at the end.
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def extract(self, idml_package):
+        pass
+
+    @abstractmethod
+    def namelist(self):
+        pass
+
+    @abstractmethod
+    def open(self, name, mode="r"):
+        pass
+
+    @abstractmethod
+    def exists(self, name):
+        pass
+
+    @abstractmethod
+    def rename(self, name, new_name):
+        pass
+
+    @abstractmethod
+    def copy(self, name, new_name):
+        pass
+
+    def read(self, name):
+        fobj = self.open(name, mode="r")
+        content = fobj.read()
+        fobj.close()
+        return content
+
+    def get_dom(self, name):
+        """Return the DOM kept for `name' or None if it must be parsed from the file. """
+        return None
+
+    def locate(self, name):
+        """Return (filename, member) where another process can read `name': a file if `member'
+        is None, else a member of the package `filename'. None if it is only in memory. """
+        return None
+
+    def synchronize(self, idml_xml_file):
+        """Push the modifications of an IDMLXMLFile instance in the working copy. """
+        fobj = self.open(idml_xml_file.name, mode="w+")
+        fobj.write(idml_xml_file.tostring())
+        fobj.close()
+
+    def write_package(self, filename):
+        """Create a new archive (a filename or a file object) from the working copy. """
+        from simple_idml.idml import IDMLPackage
+        package = IDMLPackage(filename, mode="w")
+        for name in self.namelist():
+            package.writestr(name, self.read(name))
+        package.close()
+
+    def repack(self, idml_package):
+        """Replace the `idml_package' archive with the working copy and return the new package. """
+        from simple_idml.idml import IDMLPackage
+        filename = idml_package.filename
+        # The package was opened on a file object: the new one is kept in memory too.
+        if filename is None:
+            fobj = io.BytesIO()
+            self.write_package(fobj)
+            idml_package.close()
+            self.cleanup()
+            fobj.seek(0)
+            return IDMLPackage(fobj)
+
+        # The new archive is written next to the package and renamed over it once complete,
+        # the package is left as it is if the writing fails.
+        # The members still read from `idml_package' are written before it is closed.
+        fd, tmp_filename = mkstemp(suffix=".idml", dir=os.path.dirname(os.path.abspath(filename)))
+        os.close(fd)
+        try:
+            self.write_package(tmp_filename)
+            shutil.copymode(filename, tmp_filename)
+        except:
+            os.unlink(tmp_filename)
+            raise
+        idml_package.close()
+        os.rename(tmp_filename, filename)
+        self.cleanup()
+
+        return IDMLPackage(filename)
+
+    def cleanup(self):
+        pass
+
+
+class DiskWorkingCopy(WorkingCopy):
+    """The members are extracted in a temporary directory. """
+
+    def __init__(self, path=None):
+        self.path = path or NamedTemporaryFile().name
+
+    def __repr__(self):
+        return "<%s at %s>" % (self.__class__.__name__, self.path)
+
+    def extract(self, idml_package):
+        idml_package.extractall(self.path)
+
+    def namelist(self):
+        namelist = []
+        for root, dirs, filenames in os.walk(self.path):
+            rel_root = root.replace(self.path, "")[1:]
+            for filename in filenames:
+                namelist.append("%(rel_root)s%(sep)s%(filename)s" % {
+                    'rel_root': rel_root,
+                    'sep': rel_root and "/" or "",
+                    'filename': filename
+                })
+        return namelist
+
+    def open(self, name, mode="r"):
+        filename = os.path.join(self.path, name)
+        if "r" not in mode:
+            # `Stories' directory may not be present in the package.
+            dirname = os.path.dirname(filename)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+        return open(filename, mode=mode)
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.path, name))
+
+    def locate(self, name):
+        return os.path.join(self.path, name), None
+
+    def rename(self, name, new_name):
+        os.rename(os.path.join(self.path, name), os.path.join(self.path, new_name))
+
+    def copy(self, name, new_name):
+        shutil.copy2(os.path.join(self.path, name), os.path.join(self.path, new_name))
+
+    def write_package(self, filename):
+        from simple_idml.idml import IDMLPackage
+        package = IDMLPackage(filename, mode="w")
+        for root, dirs, filenames in os.walk(self.path):
+            for f in filenames:
+                f = os.path.join(root, f)
+                arcname = f.replace(self.path, "")
+                package.write(f, arcname)
+        package.close()
+
+    def cleanup(self):
+        shutil.rmtree(self.path)
+
+
+class MemoryWorkingCopy(WorkingCopy):
+    """The members are kept in RAM, as raw bytes or as the DOM of the synchronized files.
+
+    The untouched members are only read on demand from the source package and are
+    copied as is (still compressed) in the new archive.
+    The order of the archive is preserved (`mimetype' must be the first member).
+    """
+
+    def __init__(self):
+        self.idml_package = None
+        self._members = OrderedDict()
+        self._sources = {}
+        self._serializers = {}
+        self._doms = {}
+
+    def __repr__(self):
+        return "<%s at %s>" % (self.__class__.__name__, hex(id(self)))
+
+    def extract(self, idml_package):
+        self.idml_package = idml_package
+        for info in idml_package.infolist():
+            if info.filename.endswith("/"):
+                continue
+            self._members[info.filename] = None
+            self._sources[info.filename] = info
+
+    def namelist(self):
+        return self._members.keys()
+
+    def open(self, name, mode="r"):
+        if "r" in mode and not self.exists(name):
+            raise IOError("No such member in the working copy: '%s'" % name)
+        return MemoryMember(self, name, mode)
+
+    def exists(self, name):
+        return name in self._members
+
+    def rename(self, name, new_name):
+        # Rebuild the mapping to keep the members order.
+        self._members = OrderedDict([(new_name if k == name else k, v)
+                                     for k, v in self._members.items()])
+        if name in self._sources:
+            self._sources[new_name] = self._sources.pop(name)
+        if name in self._doms:
+            self._doms[new_name] = self._doms.pop(name)
+            self._serializers[new_name] = self._serializers.pop(name)
+
+    def copy(self, name, new_name):
+        if name in self._sources:
+            self._members[new_name] = self._members[name]
+            self._sources[new_name] = self._sources[name]
+        else:
+            self._store(new_name, self.read(name))
+
+    def read(self, name):
+        content = self._members[name]
+        if content is None:
+            if name in self._sources:
+                content = self.idml_package.read(self._sources[name])
+            else:
+                content = self._serializers[name]()
+            self._members[name] = content
+        return content
+
+    def is_modified(self, name):
+        return name not in self._sources
+
+    def get_dom(self, name):
+        return self._doms.get(name)
+
+    def locate(self, name):
+        # The untouched members are in the source package, if it is a file.
+        filename = self.idml_package.filename
+        if name not in self._sources or not isinstance(filename, basestring) or not os.path.exists(filename):
+            return None
+        return filename, self._sources[name].filename
+
+    def synchronize(self, idml_xml_file):
+        # The serialization is delayed until the member is read or repacked.
+        name = idml_xml_file.name
+        self._members[name] = None
+        self._sources.pop(name, None)
+        self._doms[name] = idml_xml_file.dom
+        self._serializers[name] = idml_xml_file.tostring
+
+    def write_package(self, filename):
+        from simple_idml.idml import IDMLPackage
+        package = IDMLPackage(filename, mode="w")
+        for name in self.namelist():
+            if name in self._sources:
+                copy_zip_member(self.idml_package, package, self._sources[name], name)
+            else:
+                package.writestr(name, self.read(name))
+        package.close()
+
+    def _store(self, name, content):
+        self._members[name] = content
+        self._sources.pop(name, None)
+        self._doms.pop(name, None)
+        self._serializers.pop(name, None)
+
+    def cleanup(self):
+        self.idml_package = None
+        self._members.clear()
+        self._sources.clear()
+        self._doms.clear()
+        self._serializers.clear()
+
+
+class MemoryMember(io.BytesIO):
+    """File-like object over a MemoryWorkingCopy member. Written content is stored on close(). """
+
+    def __init__(self, working_copy, name, mode="r"):
+        content = "" if ("w" in mode) else working_copy.read(name)
+        io.BytesIO.__init__(self, content)
+        self.working_copy = working_copy
+        self.name = name
+        self.mode = mode
+        self._written = "w" in mode
+
+    def write(self, s):
+        self._written = True
+        return io.BytesIO.write(self, s)
+
+    def close(self):
+        if not self.closed and self._written:
+            self.working_copy._store(self.name, self.getvalue())
+        io.BytesIO.close(self)
+
+
+class EditSession(object):
+    """Share one working copy between several `use_working_copy' methods.
+
+    The package is repacked once when leaving the block:
+
+        with idml_package.edit() as session:
+            session.prefix("a").suffix_layers("_x")
+        new_idml_package = session.package
+    """
+
+    def __init__(self, idml_package):
+        self.package = idml_package
+        self.working_copy = None
+
+    def __getattr__(self, name):
+        return getattr(self.package, name)
+
+    def __enter__(self):
+        if self.package.working_copy is not None:
+            raise ValueError("%r is already edited." % self.package)
+        self.working_copy = self.package.working_copy_class()
+        self.working_copy.extract(self.package)
+        self.package.working_copy = self.working_copy
+        self.package.init_lazy_references()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # In debug the working copy is left for inspection.
+            if not self.package.debug:
+                self.package.working_copy = None
+                self.package.init_lazy_references()
+                self.working_copy.cleanup()
+            return False
+
+        self.package.synchronize_idml_xml_files()
+        self.package.working_copy = None
+        self.package = self.working_copy.repack(self.package)
+        self.working_copy = None
+        return False
+
+
+def get_working_copy(working_copy):
+    """A working copy may be given as a path to an extracted package. """
+    if working_copy is None or isinstance(working_copy, WorkingCopy):
+        return working_copy
+    return DiskWorkingCopy(working_copy)
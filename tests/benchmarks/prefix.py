@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare prefix() sequentially and in a pool of processes, on a synthetic
+package of 1,000 stories:
+
+    $ cd tests && python benchmarks/prefix.py [number of stories] [workers]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from simple_idml.idml import IDMLPackage
+from xml_structure import create_package
+
+IDMLFILES_DIR = os.path.join(os.path.dirname(__file__), '..', 'regressiontests', 'IDML')
+
+
+def prefix(filename, workers):
+    with IDMLPackage(filename) as idml_package:
+        start = time.time()
+        with idml_package.prefix("FOO", workers=workers) as prefixed_package:
+            return time.time() - start, len(prefixed_package.stories)
+
+
+def main():
+    stories = len(sys.argv) > 1 and int(sys.argv[1]) or 1000
+    workers = len(sys.argv) > 2 and int(sys.argv[2]) or 4
+    filename = "%s.idml" % tempfile.NamedTemporaryFile().name
+    create_package(filename, stories)
+    with IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages.idml")) as idml_package:
+        designmap = idml_package.read("designmap.xml")
+    with IDMLPackage(filename, mode="a") as idml_package:
+        idml_package.writestr("designmap.xml", designmap)
+    try:
+        print "%d stories." % stories
+        for w in (0, workers):
+            duration, prefixed_stories = prefix(filename, w)
+            assert prefixed_stories == stories
+            print "%s: %.3fs" % (w and "%d processes" % w or "sequential", duration)
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == "__main__":
+    main()
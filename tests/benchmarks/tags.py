@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare the merge of the tags of a package with a XPath lookup per tag and
+with Tags.add_tags(), on two synthetic Tags.xml of 5,000 tags sharing half of them:
+
+    $ cd tests && python benchmarks/tags.py [number of tags]
+"""
+
+import copy
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from simple_idml.components import Tags
+from simple_idml.idml import IDMLPackage
+
+TAGS = u"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<idPkg:Tags xmlns:idPkg="http://ns.adobe.com/AdobeInDesign/idml/1.0/packaging" DOMVersion="7.5">
+%(tags)s
+</idPkg:Tags>
+"""
+
+TAG = u"""  <XMLTag Self="XMLTag/tag%(i)d" Name="tag%(i)d">
+    <Properties>
+      <TagColor type="enumeration">Green</TagColor>
+    </Properties>
+  </XMLTag>"""
+
+
+def create_package(filename, first_tag, tags=5000):
+    package = IDMLPackage(filename, mode="w")
+    package.writestr("mimetype", "application/vnd.adobe.indesign-idml-package")
+    package.writestr("XML/Tags.xml", (TAGS % {
+        "tags": "\n".join([TAG % {"i": i} for i in range(first_tag, first_tag + tags)])
+    }).encode("utf-8"))
+    package.close()
+
+
+def merge_with_xpath(tags, tags_to_add):
+    tags_root_elt = tags.get_root()
+    for tag in tags_to_add:
+        if not tags_root_elt.xpath("//XMLTag[@Self='%s']" % (tag.get("Self"))):
+            tags_root_elt.append(copy.deepcopy(tag))
+
+
+def merge_with_add_tags(tags, tags_to_add):
+    tags.add_tags(tags_to_add)
+
+
+def merge(filename, tags_to_add, merge_func):
+    with IDMLPackage(filename) as idml_package:
+        tags = Tags(idml_package)
+        tags.dom
+        start = time.time()
+        merge_func(tags, tags_to_add)
+        return time.time() - start, len(tags.tags())
+
+
+def main():
+    tags = len(sys.argv) > 1 and int(sys.argv[1]) or 5000
+    filename = "%s.idml" % tempfile.NamedTemporaryFile().name
+    other_filename = "%s.idml" % tempfile.NamedTemporaryFile().name
+    create_package(filename, 0, tags)
+    create_package(other_filename, tags / 2, tags)
+    try:
+        with IDMLPackage(other_filename) as idml_package:
+            tags_to_add = idml_package.tags
+        print "%d tags merged in %d tags." % (tags, tags)
+        xpath, merged_tags = merge(filename, tags_to_add, merge_with_xpath)
+        add_tags, add_tags_merged_tags = merge(filename, tags_to_add, merge_with_add_tags)
+        assert merged_tags == add_tags_merged_tags == tags + tags / 2
+        print "xpath: %.3fs" % xpath
+        print "add_tags: %.3fs" % add_tags
+    finally:
+        os.unlink(filename)
+        os.unlink(other_filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare the sequential and the concurrent discovery of the xml_structure
+on a synthetic package of 1,000 stories:
+
+    $ cd tests && python benchmarks/xml_structure.py [number of stories] [workers]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from simple_idml.idml import IDMLPackage
+
+BACKING_STORY = u"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<idPkg:BackingStory xmlns:idPkg="http://ns.adobe.com/AdobeInDesign/idml/1.0/packaging" DOMVersion="10.0">
+  <XmlStory Self="u83" AppliedTOCStyle="n" TrackChanges="false" StoryTitle="$ID/" AppliedNamedGrid="n">
+    <ParagraphStyleRange AppliedParagraphStyle="ParagraphStyle/$ID/NormalParagraphStyle">
+      <CharacterStyleRange AppliedCharacterStyle="CharacterStyle/$ID/[No character style]">
+        <XMLElement Self="di3" MarkupTag="XMLTag/Root">
+%(elements)s
+        </XMLElement>
+      </CharacterStyleRange>
+    </ParagraphStyleRange>
+  </XmlStory>
+</idPkg:BackingStory>
+"""
+
+BACKING_STORY_ELEMENT = u"""          <XMLElement Self="di3i%(i)d" MarkupTag="XMLTag/module" XMLContent="u%(i)d" />"""
+
+STORY = u"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<idPkg:Story xmlns:idPkg="http://ns.adobe.com/AdobeInDesign/idml/1.0/packaging" DOMVersion="10.0">
+  <Story Self="u%(i)d" AppliedTOCStyle="n" TrackChanges="false" StoryTitle="$ID/" AppliedNamedGrid="n">
+    <XMLElement Self="di3i%(i)d" MarkupTag="XMLTag/module" XMLContent="u%(i)d">
+%(paragraphs)s
+    </XMLElement>
+  </Story>
+</idPkg:Story>
+"""
+
+PARAGRAPH = u"""      <ParagraphStyleRange AppliedParagraphStyle="ParagraphStyle/$ID/NormalParagraphStyle">
+        <XMLElement Self="di3i%(i)di%(j)d" MarkupTag="XMLTag/paragraph">
+          <CharacterStyleRange AppliedCharacterStyle="CharacterStyle/$ID/[No character style]" PointSize="10">
+            <Content>Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor.</Content>
+          </CharacterStyleRange>
+        </XMLElement>
+        <Br />
+      </ParagraphStyleRange>"""
+
+
+def create_package(filename, stories=1000, paragraphs=50):
+    package = IDMLPackage(filename, mode="w")
+    package.writestr("mimetype", "application/vnd.adobe.indesign-idml-package")
+    package.writestr("XML/BackingStory.xml", (BACKING_STORY % {
+        "elements": "\n".join([BACKING_STORY_ELEMENT % {"i": i} for i in range(stories)])
+    }).encode("utf-8"))
+    for i in range(stories):
+        package.writestr("Stories/Story_u%d.xml" % i, (STORY % {
+            "i": i,
+            "paragraphs": "\n".join([PARAGRAPH % {"i": i, "j": j} for j in range(paragraphs)])
+        }).encode("utf-8"))
+    package.close()
+
+
+def discover(filename, workers):
+    with IDMLPackage(filename) as idml_package:
+        start = time.time()
+        structure = idml_package._discover_xml_structure(workers=workers)
+        return time.time() - start, len(structure.xpath("//*"))
+
+
+def main():
+    stories = len(sys.argv) > 1 and int(sys.argv[1]) or 1000
+    workers = len(sys.argv) > 2 and int(sys.argv[2]) or 4
+    filename = "%s.idml" % tempfile.NamedTemporaryFile().name
+    create_package(filename, stories)
+    try:
+        sequential, nodes = discover(filename, 0)
+        concurrent, concurrent_nodes = discover(filename, workers)
+        assert nodes == concurrent_nodes
+        print "%d stories, %d nodes in the structure." % (stories, nodes)
+        print "sequential: %.3fs" % sequential
+        print "concurrent (%d threads): %.3fs" % (workers, concurrent)
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,8 @@ import unittest
 from decimal import Decimal
 from lxml import etree
 from simple_idml.components import RECTO, VERSO
-from simple_idml.components import Spread, Story, Style, StyleMapping, XMLElement
+from simple_idml.components import Fonts, Spread, SpreadGeometryIndex, Story, Style, StyleMapping, Tags, XMLElement
+from simple_idml.components import get_idml_xml_file_by_name
 from simple_idml.idml import IDMLPackage
 from simple_idml.utils import etree_dom_to_tree
 
@@ -142,6 +143,92 @@ class SpreadTestCase(unittest.TestCase):
     def test_set_element_resource_path(self):
         pass
 
+    def test_remove_page_item(self):
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages.idml"), mode="r")
+        spread = Spread(idml_file, "Spreads/Spread_ub6.xml")
+        self.assertEqual(spread.get_element_by_id("u102", tag="*", attr="ParentStory").get("Self"), "ud8")
+
+        spread.remove_page_item("u102")
+        self.assertEqual(spread.get_element_by_id("u102", tag="*", attr="ParentStory"), None)
+        self.assertEqual(spread.get_element_by_id("ud8", tag="*"), None)
+
+    def test_geometry_queries(self):
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "magazineA-courrier-des-lecteurs-3pages.idml"), mode="r")
+        spread = Spread(idml_file, idml_file.spreads[1])
+
+        self.assertEqual([i.get("Self") for i in spread.get_page_items(0)], ["u278"])
+        self.assertEqual(spread.get_page_items(spread.pages[1]), spread.pages[1].page_items)
+        self.assertEqual(spread.get_item_page("u278").node.get("Name"), "2")
+        self.assertEqual(spread.get_item_page("u29c").node.get("Name"), "3")
+        self.assertEqual(spread.get_item_page("unknown"), None)
+
+        self.assertEqual([i.get("Self") for i in spread.get_items_in_rectangle(0, -400, 100, 0)],
+                         ["u27b", "u28f", "u297"])
+        self.assertEqual(spread.get_items_in_rectangle(-10, -400, 10, -350), [])
+        self.assertEqual(spread.geometry_index.bounding_boxes[spread.get_element_by_id("u278", tag="*")], (
+            Decimal('-530.9291338582677'),
+            Decimal('-343.8425196850394'),
+            Decimal('-36.0000000000000'),
+            Decimal('343.8425196850394')
+        ))
+
+        # The index follows the modifications of the spread.
+        spread.remove_page_item("u278")
+        self.assertEqual(spread.get_page_items(0), [])
+
+    def test_geometry_of_groups(self):
+        group = etree.fromstring("""
+            <Group Self="u1" ItemTransform="1 0 0 1 100 50">
+                <Rectangle Self="u2" ItemTransform="0 1 -1 0 10 0">
+                    <Properties><PathGeometry><GeometryPathType><PathPointArray>
+                        <PathPointType Anchor="0 0"/>
+                        <PathPointType Anchor="20 0"/>
+                        <PathPointType Anchor="20 10"/>
+                        <PathPointType Anchor="0 10"/>
+                    </PathPointArray></GeometryPathType></PathGeometry></Properties>
+                </Rectangle>
+            </Group>""")
+        anchor, bounding_box = SpreadGeometryIndex.get_geometry(group)
+        self.assertEqual(bounding_box, (Decimal("100"), Decimal("50"), Decimal("110"), Decimal("70")))
+        self.assertEqual(anchor, (Decimal("100"), Decimal("50")))
+
+    def test_transform_items(self):
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "magazineA-courrier-des-lecteurs-3pages.idml"), mode="r")
+        spread = Spread(idml_file, idml_file.spreads[1])
+        x1, y1, x2, y2 = spread.geometry_index.bounding_boxes[spread.get_element_by_id("u28f", tag="*")]
+
+        # An item selected twice is transformed once.
+        transformed_items = spread.transform_items(["u28f", "u278", "u28f"], "1 0 0 1 10 20")
+        self.assertEqual([i.get("Self") for i in transformed_items], ["u28f", "u278"])
+        self.assertEqual(spread.get_element_by_id("u28f", tag="*").get("ItemTransform"),
+                         "1 0 0 1 292.992125984252 -87.24409448818915")
+        self.assertEqual(spread.get_element_by_id("u278", tag="*").get("ItemTransform"),
+                         "1 -0 -0 1 10 -919.6850393700788")
+        # The geometry index follows the transformation.
+        self.assertEqual(spread.geometry_index.bounding_boxes[spread.get_element_by_id("u28f", tag="*")],
+                         (x1 + 10, y1 + 20, x2 + 10, y2 + 20))
+
+        spread.transform_items("Polygon[@Self='u295']", [0, 1, -1, 0, 0, 0])
+        self.assertEqual(spread.get_element_by_id("u295", tag="*").get("ItemTransform"),
+                         "0 1 -1 0 906.9452158720906 190.91509240097184")
+
+        # The nested items are transformed in the coordinates of their parent
+        # and move with their selected parent.
+        group = etree.fromstring("""
+            <Group Self="u1" ItemTransform="2 0 0 2 100 50">
+                <Rectangle Self="u2" ItemTransform="1 0 0 1 10 0"/>
+            </Group>""")
+        spread.node.append(group)
+        spread.index_element(group)
+        self.assertEqual([i.get("Self") for i in spread.transform_items(["u2", "u1"], "1 0 0 1 10 20")], ["u1"])
+        self.assertEqual(group.get("ItemTransform"), "2 0 0 2 110 70")
+        self.assertEqual(group[0].get("ItemTransform"), "1 0 0 1 10 0")
+
+        spread.transform_items(["u2"], "1 0 0 1 10 20")
+        self.assertEqual(group[0].get("ItemTransform"), "1 0 0 1 15 10")
+        spread.transform_items(["u2"], "0 1 -1 0 0 0")
+        self.assertEqual(group[0].get("ItemTransform"), "0 1 -1 0 -100 35")
+
     def test_has_any_item_on_layer(self):
         idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages-layers-with-guides.idml"), mode="r")
         spreads = idml_file.spreads
@@ -170,6 +257,20 @@ class SpreadTestCase(unittest.TestCase):
         spread1 = Spread(idml_file, spreads[0])
         self.assertFalse(spread1.has_any_guide_on_layer("ub3"))
 
+    def test_layer_counts(self):
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages-layers-with-guides.idml"), mode="r")
+        spreads = idml_file.spreads
+
+        # Spread_ud8.xml
+        spread1 = Spread(idml_file, spreads[0])
+        self.assertEqual(spread1.layer_items_count, {"ua4": 6, "u2db": 2})
+        self.assertEqual(spread1.layer_guides_count, {"ua4": 10, "u2db": 6})
+
+        # The counts follow the modifications of the spread.
+        spread1.remove_guides_on_layer("u2db")
+        self.assertEqual(spread1.layer_guides_count, {"ua4": 10})
+        self.assertEqual(spread1.layer_items_count, {"ua4": 6, "u2db": 2})
+
     def test_remove_guides_on_layer(self):
         idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages-layers-with-guides.idml"), mode="r")
         spreads = idml_file.spreads
@@ -211,6 +312,38 @@ class StoryTestCase(unittest.TestCase):
         elem = story.get_element_by_id("di2i3i2", tag="*")
         self.assertEqual(elem.get("MarkupTag"), "XMLTag/content")
 
+        self.assertEqual(story.get_element_by_id("u11b", tag="Story").tag, "Story")
+        self.assertEqual(story.get_element_by_id("u11b", tag="*", attr="XMLContent").get("Self"), "di2i3i2")
+        self.assertEqual(story.get_element_by_id("di2i3i2", tag="Story"), None)
+        self.assertEqual(story.get_element_by_id("unknown"), None)
+
+    def test_get_element_by_id_after_modifications(self):
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages.idml"), mode="r")
+        story = Story(idml_file, "Stories/Story_u102.xml")
+        self.assertEqual(story.get_element_by_id("di2i3i1").get("XMLContent"), "ue4")
+
+        # The index is updated when an element is added or removed.
+        story.add_element("di2i3i4", XMLElement(tag="foo").element)
+        self.assertEqual(story.get_element_by_id("di2i3i4i1").get("MarkupTag"), "XMLTag/foo")
+
+        story.remove_element("di2i3i1")
+        self.assertEqual(story.get_element_by_id("di2i3i1"), None)
+        self.assertEqual(story.get_element_by_id("ue4", tag="*", attr="XMLContent"), None)
+
+        # Elements removed without the Story API are not returned either.
+        elt = story.get_element_by_id("di2i3i2")
+        elt.getparent().remove(elt.element)
+        self.assertEqual(story.get_element_by_id("di2i3i2"), None)
+
+        # The first element in the document order is returned, as with a XPath lookup.
+        elt = story.get_element_by_id("di2i3", tag="*")
+        duplicate = etree.Element("XMLElement", Self="di2i3i3", MarkupTag="XMLTag/duplicate")
+        elt.element.insert(0, duplicate)
+        story.index_element(duplicate)
+        self.assertEqual(story.get_element_by_id("di2i3i3").get("MarkupTag"), "XMLTag/duplicate")
+        self.assertEqual(story.get_element_by_id("di2i3i3").get("MarkupTag"),
+                         story.dom.xpath("//XMLElement[@Self='di2i3i3']")[0].get("MarkupTag"))
+
     def test_create(self):
         from tempfile import mkdtemp
         idml_working_copy = mkdtemp()
@@ -323,6 +456,66 @@ class PageTestCase(unittest.TestCase):
         self.assertEqual(page2.face, RECTO)
 
 
+class FontsTestCase(unittest.TestCase):
+    def test_add_font_family(self):
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages.idml"), mode="r")
+        fonts = Fonts(idml_file)
+        families = [family.get("Name") for family in fonts.fonts()]
+
+        # A family with the same `Name' is not added again.
+        minion = fonts.fonts()[0]
+        fonts_count = len(minion)
+        fonts.add_font_family(etree.fromstring('<FontFamily Self="foodi3e" Name="Minion Pro"/>'))
+        self.assertEqual([family.get("Name") for family in fonts.fonts()], families)
+        self.assertEqual(len(minion), fonts_count)
+        self.assertFalse(fonts.dirty)
+
+        # Its missing fonts are added.
+        family = fonts.add_font_family(etree.fromstring("""
+            <FontFamily Self="foodi3e" Name="Minion Pro">
+                <Font Self="foodi3eFontnMinion Pro Regular" Name="Minion Pro Regular"/>
+                <Font Self="foodi3eFontnMinion Pro Black" Name="Minion Pro Black"/>
+            </FontFamily>"""))
+        self.assertTrue(family is minion)
+        self.assertEqual(len(minion), fonts_count + 1)
+        self.assertEqual(minion[-1].get("Self"), "foodi3eFontnMinion Pro Black")
+        self.assertTrue(fonts.dirty)
+
+        family = fonts.add_font_family(etree.fromstring('<FontFamily Self="foo" Name="Foo"/>'))
+        self.assertEqual([f.get("Name") for f in fonts.fonts()], families + ["Foo"])
+        self.assertTrue(fonts.get_font_family(family) is family)
+
+    def test_add_font_family_with_same_self(self):
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages.idml"), mode="r")
+        fonts = Fonts(idml_file)
+        minion = fonts.fonts()[0]
+        fonts_count = len(minion)
+        self.assertEqual(minion.get("Self"), "di3e")
+
+        # The `Self' values of another package may be the ones of other families and fonts.
+        family = fonts.add_font_family(etree.fromstring("""
+            <FontFamily Self="di3e" Name="Helvetica">
+                <Font Self="di3eFontnMinion Pro Regular" FontFamily="Helvetica" Name="Helvetica"/>
+            </FontFamily>"""))
+        self.assertFalse(family is minion)
+        self.assertEqual(len(minion), fonts_count)
+        self.assertEqual(fonts.fonts()[-1].get("Name"), "Helvetica")
+        self.assertEqual([font.get("Name") for font in family], ["Helvetica"])
+        # They are replaced: the `Self' values stay unique.
+        self.assertEqual(family.get("Self"), "di3e_1")
+        self.assertEqual([font.get("Self") for font in family], ["di3e_1FontnMinion Pro Regular"])
+
+        family = fonts.add_font_family(etree.fromstring("""
+            <FontFamily Self="di3f" Name="Helvetica">
+                <Font Self="di3eFontnMinion Pro Regular" FontFamily="Helvetica" Name="Minion Pro Regular"/>
+                <Font Self="di3fFontnHelvetica Bold" FontFamily="Helvetica" Name="Helvetica Bold"/>
+            </FontFamily>"""))
+        self.assertEqual([font.get("Name") for font in family], ["Helvetica", "Helvetica Bold"])
+
+        self_values = [elt.get("Self") for elt in fonts.dom.iter() if elt.get("Self") is not None]
+        self.assertEqual(len(self_values), len(set(self_values)))
+
+
 class StyleTestCase(unittest.TestCase):
     def test_get_style_node_by_name(self):
         idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), mode="r")
@@ -366,6 +559,68 @@ class StyleTestCase(unittest.TestCase):
             'text': ''
         })
 
+    def test_add_style_group(self):
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), mode="r")
+        style = Style(idml_file)
+        styles = [elt.get("Self") for elt in style.get_root().find("RootCharacterStyleGroup")]
+        self.assertRaises(IndexError, style.get_style_node_by_name, "CharacterStyle/foo")
+
+        # The styles already in the group are skipped.
+        group = style.add_style_group(etree.fromstring("""
+            <RootCharacterStyleGroup Self="u65">
+                <CharacterStyle Self="CharacterStyle/bold" Name="bold" FontStyle="Black"/>
+                <CharacterStyle Self="CharacterStyle/foo" Name="foo"/>
+                <CharacterStyleGroup Self="CharacterStyleGroup/bar" Name="bar">
+                    <CharacterStyle Self="CharacterStyleGroup/bar:CharacterStyle/baz" Name="baz"/>
+                </CharacterStyleGroup>
+            </RootCharacterStyleGroup>"""))
+        self.assertEqual([elt.get("Self") for elt in group], styles + [
+            "CharacterStyle/foo",
+            "CharacterStyleGroup/bar"
+        ])
+        self.assertEqual(style.get_style_node_by_name("CharacterStyle/bold").get("FontStyle"), "Bold")
+        self.assertEqual(style.get_style_node_by_name("CharacterStyle/foo").get("Name"), "foo")
+
+        # The nested groups are completed.
+        style.add_style_group(etree.fromstring("""
+            <RootCharacterStyleGroup Self="u65">
+                <CharacterStyleGroup Self="CharacterStyleGroup/bar" Name="bar">
+                    <CharacterStyle Self="CharacterStyleGroup/bar:CharacterStyle/baz" Name="baz"/>
+                    <CharacterStyle Self="CharacterStyleGroup/bar:CharacterStyle/qux" Name="qux"/>
+                </CharacterStyleGroup>
+            </RootCharacterStyleGroup>"""))
+        self.assertEqual([elt.get("Name") for elt in group[-1]], ["baz", "qux"])
+
+        # A style of another group is not a style of the group.
+        style.add_style_group(etree.fromstring("""
+            <RootCharacterStyleGroup Self="u65">
+                <CharacterStyle Self="CharacterStyleGroup/bar:CharacterStyle/baz" Name="baz"/>
+            </RootCharacterStyleGroup>"""))
+        self.assertEqual(group[-1].get("Self"), "CharacterStyleGroup/bar:CharacterStyle/baz")
+        self.assertEqual(group[-1].getparent(), group)
+        self.assertEqual([elt.get("Name") for elt in group[-2]], ["baz", "qux"])
+
+        # A missing group is added.
+        style.add_style_group(etree.fromstring('<RootFooStyleGroup Self="foo"/>'))
+        self.assertEqual(style.style_groups()[-1].tag, "RootFooStyleGroup")
+        self.assertTrue(style.dirty)
+
+
+class TagsTestCase(unittest.TestCase):
+    def test_add_tags(self):
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages.idml"), mode="r")
+        tags = Tags(idml_file)
+        tag_ids = [tag.get("Self") for tag in tags.tags()]
+        added_tags = tags.add_tags([
+            etree.fromstring('<XMLTag Self="XMLTag/article" Name="article"/>'),
+            etree.fromstring('<XMLTag Self="XMLTag/foo" Name="foo"/>'),
+            etree.fromstring('<XMLTag Self="XMLTag/foo" Name="foo"/>'),
+        ])
+        self.assertEqual([tag.get("Self") for tag in added_tags], ["XMLTag/foo"])
+        self.assertEqual([tag.get("Self") for tag in tags.tags()], tag_ids + ["XMLTag/foo"])
+        self.assertTrue(tags.get_element_by_id("XMLTag/foo", tag="XMLTag") is added_tags[0])
+        self.assertTrue(tags.dirty)
+
 
 class StyleMappingTestCase(unittest.TestCase):
     def test_styles(self):
@@ -498,7 +753,9 @@ def suite():
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(DesignmapTestCase))
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(StoryTestCase))
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(PageTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(FontsTestCase))
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(StyleTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TagsTestCase))
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(StyleMappingTestCase))
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(XMLElementTestCase))
     return suite
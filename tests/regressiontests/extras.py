@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import os
+import shutil
+import unittest
+from simple_idml.extras import render_xml_payloads
+from simple_idml.idml import IDMLPackage
+
+CURRENT_DIR = os.path.dirname(__file__)
+IDMLFILES_DIR = os.path.join(CURRENT_DIR, "IDML")
+XML_DIR = os.path.join(CURRENT_DIR, "XML")
+OUTPUT_DIR = os.path.join(CURRENT_DIR, "outputs", "extras")
+
+
+class RenderXMLPayloadsTestCase(unittest.TestCase):
+    def setUp(self):
+        super(RenderXMLPayloadsTestCase, self).setUp()
+        if os.path.exists(OUTPUT_DIR):
+            shutil.rmtree(OUTPUT_DIR)
+        os.makedirs(OUTPUT_DIR)
+        self.template = os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml")
+        self.payloads = [os.path.join(XML_DIR, "article-1photo_import-xml.xml"),
+                         ("bad-payload", "<module><headline>"),
+                         os.path.join(XML_DIR, "article-1photo_import-xml-nested-tags.xml")]
+
+    def _assert_results(self, results):
+        self.assertEqual([r["name"] for r in results],
+                         ["article-1photo_import-xml", "bad-payload", "article-1photo_import-xml-nested-tags"])
+        self.assertEqual(results[0]["error"], None)
+        self.assertTrue("XMLSyntaxError" in results[1]["error"])
+        self.assertEqual(results[2]["error"], None)
+        self.assertTrue(all([r["duration"] >= 0 for r in results]))
+        self.assertEqual(sorted(os.listdir(OUTPUT_DIR)),
+                         ["article-1photo_import-xml-nested-tags.idml", "article-1photo_import-xml.idml"])
+
+        with IDMLPackage(results[2]["destination"]) as idml_file:
+            self.assertEqual(idml_file.testzip(), None)
+            self.assertTrue("<italique>Belafonte</italique>" in idml_file.export_xml())
+
+    def test_render_xml_payloads(self):
+        results = render_xml_payloads(self.template, self.payloads, OUTPUT_DIR,
+                                      at="/Root/module[1]", processes=1)
+        self._assert_results(results)
+
+    def test_render_xml_payloads_with_pool(self):
+        results = render_xml_payloads(self.template, self.payloads, OUTPUT_DIR,
+                                      at="/Root/module[1]", processes=2, use_plan=False)
+        self._assert_results(results)
+
+    def test_render_xml_payloads_with_pool_and_plan(self):
+        results = render_xml_payloads(self.template, self.payloads, OUTPUT_DIR,
+                                      at="/Root/module[1]", processes=2)
+        self._assert_results(results)
+
+    def test_render_xml_payloads_invalid_at(self):
+        # The plan is compiled before the pool is started: the error is not raised in the workers.
+        self.assertRaises(IndexError, render_xml_payloads, self.template, self.payloads, OUTPUT_DIR,
+                          at="/Root/nope[1]", processes=2)
+        self.assertEqual(os.listdir(OUTPUT_DIR), [])
+
+    def test_render_xml_payloads_from_dir(self):
+        results = render_xml_payloads(self.template, XML_DIR, OUTPUT_DIR,
+                                      at="/Root/module[1]", processes=1)
+        self.assertEqual([r["name"] for r in results],
+                         [os.path.splitext(os.path.basename(f))[0]
+                          for f in sorted(glob.glob(os.path.join(XML_DIR, "*.xml")))])
+        self.assertEqual([r["error"] for r in results], [None] * len(results))
+
+
+def suite():
+    suite = unittest.TestLoader().loadTestsFromTestCase(RenderXMLPayloadsTestCase)
+    return suite
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+from decimal import Decimal
+from lxml import etree
+from simple_idml.components import Spread
+from simple_idml.components import RECTO
+from simple_idml.geometry import NumpyGeometryEngine
+from simple_idml.geometry import get_geometry_engine, invert_transform, multiply_transforms, numpy
+from simple_idml.idml import IDMLPackage
+
+CURRENT_DIR = os.path.dirname(__file__)
+IDMLFILES_DIR = os.path.join(CURRENT_DIR, "IDML")
+
+
+def get_elements(*item_transforms):
+    return [etree.Element("Rectangle", ItemTransform=item_transform) for item_transform in item_transforms]
+
+
+class DecimalGeometryEngineTestCase(unittest.TestCase):
+    def test_get_geometry_engine(self):
+        self.assertEqual(get_geometry_engine().name, "decimal")
+        self.assertEqual(get_geometry_engine("decimal").name, "decimal")
+        self.assertRaises(ValueError, get_geometry_engine, "foo")
+
+    def test_translate(self):
+        elements = get_elements("1 0 0 1 0 0", "0 1 -1 0 -530.9291338582677 -343.8425196850394")
+        get_geometry_engine().translate(elements, (Decimal("10.5"), -2.1))
+        self.assertEqual([elt.get("ItemTransform") for elt in elements], [
+            "1 0 0 1 10.5 -2.1",
+            "0 1 -1 0 -520.4291338582677 -345.9425196850394",
+        ])
+
+    def test_transform(self):
+        elements = get_elements("1 0 0 1 0 0", "0 1 -1 0 -530.9291338582677 -343.8425196850394")
+        get_geometry_engine().transform(elements, "0 -1 1 0 10.5 0".split(" "))
+        self.assertEqual([elt.get("ItemTransform") for elt in elements], [
+            "0 -1 1 0 10.5 0",
+            "1 0 0 1 -333.3425196850394 530.9291338582677",
+        ])
+
+    def test_transform_each(self):
+        elements = get_elements("1 0 0 1 0 0", "0 1 -1 0 -530.9291338582677 -343.8425196850394", "1 0 0 1 5 5")
+        rotation = "0 -1 1 0 10.5 0".split(" ")
+        get_geometry_engine().transform_each(elements, [rotation, "2 0 0 2 0 0".split(" "), rotation])
+        self.assertEqual([elt.get("ItemTransform") for elt in elements], [
+            "0 -1 1 0 10.5 0",
+            "0 2 -2 0 -1061.8582677165354 -687.6850393700788",
+            "0 -1 1 0 15.5 -5",
+        ])
+
+    def test_invert_transform(self):
+        transform = [Decimal(v) for v in "0 2 -2 0 -90 140".split(" ")]
+        inverse = invert_transform(transform)
+        self.assertEqual(inverse, [0, Decimal("-0.5"), Decimal("0.5"), 0, -70, -45])
+        self.assertEqual(multiply_transforms(transform, inverse), [1, 0, 0, 1, 0, 0])
+        self.assertRaises(ValueError, invert_transform, [Decimal(v) for v in "1 2 2 4 0 0".split(" ")])
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed.")
+class NumpyGeometryEngineTestCase(unittest.TestCase):
+    def test_translate(self):
+        engine = get_geometry_engine("numpy")
+        elements = get_elements("1 0 0 1 0 0", "0 1 -1 0 -530.9291338582677 -343.8425196850394")
+        engine.translate(elements, (Decimal("10.5"), -2.1))
+        # Only the translation is written, at `precision' decimals.
+        self.assertEqual([elt.get("ItemTransform") for elt in elements], [
+            "1 0 0 1 10.5 -2.1",
+            "0 1 -1 0 -520.4291338583 -345.942519685",
+        ])
+
+        # The values are stable once written.
+        engine.translate(elements, (0, 0))
+        self.assertEqual(elements[1].get("ItemTransform"), "0 1 -1 0 -520.4291338583 -345.942519685")
+
+        engine.translate(elements, (-10.5, 2.1))
+        self.assertEqual(elements[0].get("ItemTransform"), "1 0 0 1 0 0")
+
+    def test_transform(self):
+        elements = get_elements("1 0 0 1 0 0", "0 1 -1 0 -530.9291338582677 -343.8425196850394")
+        get_geometry_engine("numpy").transform(elements, "0 -1 1 0 10.5 0".split(" "))
+        self.assertEqual([elt.get("ItemTransform") for elt in elements], [
+            "0 -1 1 0 10.5 0",
+            "1 0 0 1 -333.342519685 530.9291338583",
+        ])
+
+    def test_transform_each(self):
+        elements = get_elements("1 0 0 1 0 0", "0 1 -1 0 -530.9291338582677 -343.8425196850394", "1 0 0 1 5 5")
+        rotation = "0 -1 1 0 10.5 0".split(" ")
+        get_geometry_engine("numpy").transform_each(elements, [rotation, "2 0 0 2 0 0".split(" "), rotation])
+        self.assertEqual([elt.get("ItemTransform") for elt in elements], [
+            "0 -1 1 0 10.5 0",
+            "0 2 -2 0 -1061.8582677165 -687.6850393701",
+            "0 -1 1 0 15.5 -5",
+        ])
+
+    def test_transform_items(self):
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "magazineA-courrier-des-lecteurs-3pages.idml"), mode="r")
+        idml_file.geometry_engine = "numpy"
+        spread = Spread(idml_file, idml_file.spreads[1])
+        group = etree.fromstring("""
+            <Group Self="u1" ItemTransform="2 0 0 2 100 50">
+                <Rectangle Self="u2" ItemTransform="1 0 0 1 10 0"/>
+            </Group>""")
+        spread.node.append(group)
+        spread.index_element(group)
+
+        # The items of different parents are loaded in a single array.
+        loaded_elements = []
+        load = NumpyGeometryEngine.load
+        NumpyGeometryEngine.load = lambda engine, elements: loaded_elements.append(elements) or load(engine, elements)
+        try:
+            spread.transform_items(["u28f", "u2"], "1 0 0 1 10 20")
+        finally:
+            NumpyGeometryEngine.load = load
+        self.assertEqual(loaded_elements, [[spread.get_element_by_id("u28f", tag="*"), group[0]]])
+        self.assertEqual(spread.get_element_by_id("u28f", tag="*").get("ItemTransform"),
+                         "1 0 0 1 292.9921259843 -87.2440944882")
+        self.assertEqual(group[0].get("ItemTransform"), "1 0 0 1 15 10")
+
+    def test_set_face(self):
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "magazineA-courrier-des-lecteurs.idml"), mode="r")
+        spread = Spread(idml_file, idml_file.spreads[1])
+        page = spread.pages[0]
+        item_transforms = [item.get("ItemTransform") for item in page.page_items]
+        page.set_face(RECTO)
+        decimal_item_transforms = [item.get("ItemTransform") for item in page.page_items]
+        self.assertNotEqual(decimal_item_transforms, item_transforms)
+
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "magazineA-courrier-des-lecteurs.idml"), mode="r")
+        idml_file.geometry_engine = "numpy"
+        spread = Spread(idml_file, idml_file.spreads[1])
+        page = spread.pages[0]
+        page.set_face(RECTO)
+        for item, item_transform in zip(page.page_items, decimal_item_transforms):
+            for value, decimal_value in zip(item.get("ItemTransform").split(" "), item_transform.split(" ")):
+                self.assertAlmostEqual(float(value), float(decimal_value), places=9)
+
+
+def suite():
+    suite = unittest.TestLoader().loadTestsFromTestCase(DecimalGeometryEngineTestCase)
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(NumpyGeometryEngineTestCase))
+    return suite
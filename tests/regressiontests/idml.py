@@ -3,12 +3,15 @@
 import glob
 import os
 import shutil
+import sys
 import unittest
+from io import BytesIO
 from tempfile import mkdtemp
 from lxml import etree
 from simple_idml.idml import IDMLPackage
 from simple_idml.test import SimpleTestCase
 from simple_idml.utils import etree_dom_to_tree
+from simple_idml.working_copy import DiskWorkingCopy, MemoryWorkingCopy
 
 CURRENT_DIR = os.path.dirname(__file__)
 IDMLFILES_DIR = os.path.join(CURRENT_DIR, "IDML")
@@ -245,6 +248,41 @@ u"""<Root Self="di2">
 </Root>
 """)
 
+    def test_xml_structure_with_workers(self):
+        idml_filename = os.path.join(IDMLFILES_DIR, "4-pages.idml")
+        with IDMLPackage(idml_filename) as idml_file:
+            xml_structure = idml_file.xml_structure_pretty()
+
+        with IDMLPackage(idml_filename) as idml_file:
+            idml_file.xml_structure_workers = 2
+            self.assertEqual(idml_file.xml_structure_pretty(), xml_structure)
+            # The stories parsed by the threads are not kept.
+            self.assertEqual([name for name in idml_file._idml_xml_files if name in idml_file.stories], [])
+
+    def test_xml_structure_cache(self):
+        cache_dir = mkdtemp()
+        idml_filename = os.path.join(IDMLFILES_DIR, "4-pages.idml")
+        try:
+            with IDMLPackage(idml_filename) as idml_file:
+                idml_file.xml_structure_cache_dir = cache_dir
+                xml_structure = idml_file.xml_structure_pretty()
+                self.assertEqual(os.listdir(cache_dir), ["%s.xml" % idml_file.xml_structure_cache_key])
+
+            # The stories are not explored when the structure is in the cache.
+            with IDMLPackage(idml_filename) as idml_file:
+                idml_file.xml_structure_cache_dir = cache_dir
+                self.assertEqual(idml_file.xml_structure_pretty(), xml_structure)
+                self.assertEqual(idml_file._backing_story, None)
+
+            # The key changes with the stories.
+            shutil.copy2(idml_filename, os.path.join(OUTPUT_DIR, "4-pages.idml"))
+            with IDMLPackage(os.path.join(OUTPUT_DIR, "4-pages.idml")) as idml_file:
+                key = idml_file.xml_structure_cache_key
+                with idml_file.prefix("FOO") as f:
+                    self.assertNotEqual(f.xml_structure_cache_key, key)
+        finally:
+            shutil.rmtree(cache_dir)
+
     def test_get_story_by_xpath(self):
         idml_filename = os.path.join(IDMLFILES_DIR, "4-pages.idml")
         with IDMLPackage(idml_filename) as idml_file:
@@ -254,6 +292,29 @@ u"""<Root Self="di2">
             self.assertEqual(idml_file.get_story_by_xpath("/Root/article[1]/Story/title"), "Stories/Story_ue4.xml")
             self.assertEqual(idml_file.get_story_by_xpath("/Root/article[1]/illustration"), "Stories/Story_u102.xml")
 
+    def test_get_idml_xml_file(self):
+        idml_filename = os.path.join(IDMLFILES_DIR, "4-pages.idml")
+        with IDMLPackage(idml_filename) as idml_file:
+            story = idml_file.get_story_object_by_xpath("/Root/article[1]")
+            self.assertEqual(story.name, "Stories/Story_u102.xml")
+            self.assertTrue(idml_file.get_idml_xml_file("Stories/Story_u102.xml") is story)
+            self.assertTrue(idml_file.get_story_object_by_xpath("/Root/article[1]/illustration") is story)
+            self.assertTrue(idml_file.get_story_object_by_xpath("/Root") is idml_file.backing_story)
+
+            # The parsed files survive the reset of the lazy references.
+            spread = idml_file.spreads_objects[0]
+            dom = spread.dom
+            idml_file.init_lazy_references()
+            self.assertTrue(idml_file.spreads_objects[0] is spread)
+            self.assertTrue(idml_file.spreads_objects[0].dom is dom)
+
+            idml_file.invalidate_idml_xml_files(["Stories/Story_u102.xml"])
+            self.assertFalse(idml_file.get_idml_xml_file("Stories/Story_u102.xml") is story)
+            self.assertTrue(idml_file.get_idml_xml_file(spread.name) is spread)
+
+            idml_file.invalidate_idml_xml_files()
+            self.assertFalse(idml_file.get_idml_xml_file(spread.name) is spread)
+
     def test_namelist(self):
         # The namelist can be inherited from ZipFile or computed from the working copy.
         idml_filename = os.path.join(IDMLFILES_DIR, "4-pages.idml")
@@ -301,6 +362,20 @@ u"""<Root Self="di2">
             spread = idml_file.get_spread_object_by_xpath("/Root/module/main_picture")
             self.assertEqual(spread.name, "Spreads/Spread_ud8.xml")
 
+    def test_locate_spread_element(self):
+        with IDMLPackage(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml")) as idml_file:
+            spread, elt = idml_file.locate_spread_element("u14a")
+            self.assertEqual(spread.name, "Spreads/Spread_ud8.xml")
+            self.assertEqual(elt.tag, "Image")
+            self.assertTrue(idml_file.spread_locator["u14a"][1] is elt)
+            self.assertTrue(idml_file.get_spread_elem_by_xpath("/Root/module/main_picture") is elt)
+
+            # The locator entries are checked against the DOM modifications.
+            spread.remove_page_item("u14a")
+            self.assertEqual(idml_file.locate_spread_element("u14a"), None)
+            self.assertFalse("u14a" in idml_file.spread_locator)
+            self.assertEqual(idml_file.get_spread_object_by_id("u14a"), None)
+
     def test_get_element_content_id_by_xpath(self):
         with IDMLPackage(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml")) as idml_file:
             element_id = idml_file.get_element_content_id_by_xpath("/Root/module/main_picture")
@@ -360,6 +435,75 @@ u"""<Root Self="di2">
 </Root>
 """)
 
+    def test_import_xml_synchronize_once(self):
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"),
+                     os.path.join(OUTPUT_DIR, "article-1photo_import-xml-nested-tags.idml"))
+
+        synchronized = []
+
+        class RecordingWorkingCopy(MemoryWorkingCopy):
+            def synchronize(self, idml_xml_file):
+                synchronized.append(idml_xml_file.name)
+                super(RecordingWorkingCopy, self).synchronize(idml_xml_file)
+
+        with IDMLPackage(os.path.join(OUTPUT_DIR, "article-1photo_import-xml-nested-tags.idml")) as idml_file,\
+             open(os.path.join(XML_DIR, "article-1photo_import-xml-nested-tags.xml"), "r") as xml_file:
+            idml_file.working_copy_class = RecordingWorkingCopy
+            with idml_file.import_xml(xml_file.read(), at="/Root/module[1]") as f:
+                # Only the modified files are synchronized, once.
+                self.assertEqual(sorted(synchronized), ["Spreads/Spread_ud8.xml",
+                                                        "Stories/Story_u10d.xml",
+                                                        "Stories/Story_ue1.xml",
+                                                        "Stories/Story_uf7.xml"])
+                self.assertTrue("Zissou" in f.export_xml())
+
+        # Nothing is modified: there is no such layer and no orphan layer.
+        del synchronized[:]
+        idml_filename = os.path.join(OUTPUT_DIR, "4-pages-layers-with-guides.idml")
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "4-pages-layers-with-guides.idml"), idml_filename)
+        idml_file = IDMLPackage(idml_filename)
+        idml_file.working_copy_class = RecordingWorkingCopy
+        idml_file = idml_file.remove_guides_on_layer("nonexistent")
+        idml_file.working_copy_class = RecordingWorkingCopy
+        idml_file = idml_file.remove_orphan_layers()
+        self.assertEqual(synchronized, [])
+
+        idml_file.working_copy_class = RecordingWorkingCopy
+        idml_file = idml_file.remove_guides_on_layer("ua4")
+        idml_file.close()
+        self.assertEqual(synchronized, ["Spreads/Spread_ud8.xml"])
+
+    def test_import_xml_with_plan(self):
+        template_filename = os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml")
+        with IDMLPackage(template_filename) as template:
+            plan = template.compile_import_plan("/Root/module[1]")
+        self.assertEqual(plan.nodes["/Root/module[1]"], plan.nodes["/Root/module"])
+        self.assertEqual(plan.nodes["/Root/module"]["children"],
+                         [("main_picture", "/Root/module/main_picture"),
+                          ("headline", "/Root/module/headline"),
+                          ("Story", "/Root/module/Story")])
+        self.assertEqual(plan.nodes["/Root/module/main_picture"]["story"], "Stories/Story_u10d.xml")
+        self.assertEqual(plan.nodes["/Root/module/main_picture"]["spread"], "Spreads/Spread_ud8.xml")
+        self.assertEqual(plan.nodes["/Root/module/Story/article"]["story"], "Stories/Story_uf7.xml")
+        self.assertEqual(plan.nodes["/Root/module/Story/article"]["tags"], ("Root", "module", "Story", "article"))
+
+        for xml_filename in ("article-1photo_import-xml.xml", "article-1photo_import-xml-nested-tags.xml"):
+            with open(os.path.join(XML_DIR, xml_filename), "r") as xml_file:
+                xml = xml_file.read()
+            exports = []
+            # The plan is reused for each package.
+            for i, plan_arg in enumerate((None, plan, plan)):
+                idml_filename = os.path.join(OUTPUT_DIR, "article-1photo_import-xml-plan-%d.idml" % i)
+                shutil.copy2(template_filename, idml_filename)
+                with IDMLPackage(idml_filename) as idml_file:
+                    with idml_file.import_xml(xml, at="/Root/module[1]", plan=plan_arg) as f:
+                        exports.append((f.export_xml(), f.xml_structure_pretty()))
+            self.assertEqual(exports[1], exports[0])
+            self.assertEqual(exports[2], exports[0])
+
+        with IDMLPackage(template_filename) as idml_file:
+            self.assertRaises(ValueError, idml_file.import_xml, "<module/>", at="/Root", plan=plan)
+
     def test_import_xml_with_ignored_tags(self):
         shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"),
                      os.path.join(OUTPUT_DIR, "article-1photo_import-xml-with-extra-nodes.idml"))
@@ -691,6 +835,75 @@ u"""<Root>
 </Root>
 """)
 
+    def test_export_xml_from_tag(self):
+        idml_filename = os.path.join(IDMLFILES_DIR, "article-1photo_imported-nested-xml.idml")
+        with IDMLPackage(idml_filename) as idml_file:
+            xml = idml_file.export_xml(from_tag="/Root/module/Story/informations")
+            self.assertMultiLineEqual(xml,
+"""<informations>The Life Aquatic with Steve Zissou is an American comedy-drama film directed, written, and co-produced by Wes Anderson.</informations>
+""")
+            # Only the stories of the exported element and of its ancestors are parsed.
+            self.assertEqual(idml_file._xml_structure, None)
+            self.assertEqual(sorted([name for name in idml_file._idml_xml_files if name in idml_file.stories]),
+                             ["Stories/Story_u111.xml", "Stories/Story_ufb.xml"])
+            self.assertRaises(IndexError, idml_file.export_xml, from_tag="/Root/module[2]")
+            self.assertRaises(IndexError, idml_file.export_xml, from_tag="/Root/module/headline/foo")
+
+        # The same as with the discovered xml_structure.
+        with IDMLPackage(idml_filename) as idml_file, IDMLPackage(idml_filename) as discovered_idml_file:
+            discovered_idml_file.xml_structure
+            for from_tag in ("/Root", "/Root[1]/module[1]", "/Root/module/Story/article/italique[2]"):
+                self.assertMultiLineEqual(idml_file.export_xml(from_tag=from_tag),
+                                          discovered_idml_file.export_xml(from_tag=from_tag))
+                fobj = BytesIO()
+                idml_file.export_xml(from_tag=from_tag, fileobj=fobj)
+                self.assertMultiLineEqual(fobj.getvalue(), discovered_idml_file.export_xml(from_tag=from_tag))
+            self.assertEqual(idml_file._xml_structure, None)
+
+            xml = idml_file.export_xml(from_tag="//bold")
+            self.assertMultiLineEqual(xml,
+"""<bold>Steve Zissou (Bill Murray) is <sup>working</sup> on his latest documentary at sea, his best friend <italique>Esteban du Plantier</italique> (Seymour Cassel)</bold>
+""")
+            fobj = BytesIO()
+            idml_file.export_xml(from_tag="/Root/module", fileobj=fobj)
+            self.assertMultiLineEqual(fobj.getvalue(), idml_file.export_xml(from_tag="/Root/module"))
+            self.assertEqual(idml_file.export_as_tree(from_tag="/Root/module/headline"),
+                             {"tag": "headline", "attrs": {},
+                              "content": ["The Life Aquatic with Steve Zissou"]})
+
+    def test_export_xml_deeply_nested(self):
+        with IDMLPackage(os.path.join(IDMLFILES_DIR, "article-1photo_imported-nested-xml.idml")) as idml_file:
+            # Nest more elements than the recursion limit.
+            depth = sys.getrecursionlimit() + 100
+            story = idml_file.get_idml_xml_file("Stories/Story_ufb.xml")
+            node = story.get_element_by_id("di3i4i3i7").element
+            for i in range(depth):
+                node = etree.SubElement(node, "XMLElement", Self="deep%d" % i, MarkupTag="XMLTag/deep")
+            etree.SubElement(node, "Content").text = "bottom"
+            story.reset_index()
+            idml_file.init_lazy_references()
+
+            self.assertEqual(len(idml_file.xml_structure.xpath("//deep")), depth)
+            xml = idml_file.export_xml(from_tag="//informations")
+            self.assertTrue(xml.endswith("Wes Anderson.%sbottom%s</informations>\n" % ("<deep>" * depth,
+                                                                                        "</deep>" * depth)))
+            fobj = BytesIO()
+            idml_file.export_xml(from_tag="//informations", fileobj=fobj)
+            self.assertMultiLineEqual(fobj.getvalue(), xml)
+
+    def test_export_xml_to_fileobj(self):
+        for filename in ("article-1photo_imported-nested-xml.idml", "magazineA-courrier-des-lecteurs.idml"):
+            with IDMLPackage(os.path.join(IDMLFILES_DIR, filename)) as idml_file:
+                idml_file.export_xml(fileobj=BytesIO())
+                # The stories are only parsed while they are written: none is kept.
+                self.assertTrue(idml_file.stories)
+                self.assertEqual([name for name in idml_file._idml_xml_files if name in idml_file.stories], [])
+
+                for encoding in (None, "utf-8", "iso-8859-1"):
+                    fobj = BytesIO()
+                    self.assertEqual(idml_file.export_xml(encoding=encoding, fileobj=fobj), None)
+                    self.assertMultiLineEqual(fobj.getvalue(), idml_file.export_xml(encoding=encoding))
+
     def test_prefix(self):
         shutil.copy2(os.path.join(IDMLFILES_DIR, "4-pages.idml"),
                      os.path.join(OUTPUT_DIR, "4-pages.idml"))
@@ -765,6 +978,38 @@ u"""<Root Self="FOOdi2">
             with idml_file.prefix("FOO") as prefixed_f:
                 pass
 
+    def test_prefix_with_workers(self):
+        with open(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), "rb") as f:
+            content = f.read()
+        with IDMLPackage(BytesIO(content)) as idml_file:
+            prefixed_f = idml_file.prefix("FOO")
+        with IDMLPackage(BytesIO(content)) as idml_file:
+            concurrent_prefixed_f = idml_file.prefix("FOO", workers=2)
+        self.assertEqual(concurrent_prefixed_f.namelist(), prefixed_f.namelist())
+        for name in prefixed_f.namelist():
+            self.assertEqual(concurrent_prefixed_f.read(name), prefixed_f.read(name))
+
+        # The files modified in the working copy are prefixed too.
+        with IDMLPackage(BytesIO(content)) as idml_file:
+            with idml_file.edit() as session:
+                session.suffix_layers(" - 23").prefix("FOO", workers=2)
+        with session.package as f:
+            self.assertEqual(f.namelist(), prefixed_f.namelist())
+            self.assertEqual(f.designmap.layer_nodes[0].get("Name"), "Layer 1 - 23")
+            self.assertEqual(f.designmap.dom.get("StoryList"), prefixed_f.designmap.dom.get("StoryList"))
+
+        # The processes read the files themselves from a package or a working copy on the disk.
+        idml_filename = os.path.join(OUTPUT_DIR, "article-1photo_import-xml-prefixed.idml")
+        for working_copy_class in (MemoryWorkingCopy, DiskWorkingCopy):
+            with open(idml_filename, "wb") as f:
+                f.write(content)
+            with IDMLPackage(idml_filename) as idml_file:
+                idml_file.working_copy_class = working_copy_class
+                with idml_file.prefix("FOO", workers=2) as concurrent_prefixed_f:
+                    self.assertEqual(set(concurrent_prefixed_f.namelist()), set(prefixed_f.namelist()))
+                    for name in prefixed_f.namelist():
+                        self.assertEqual(concurrent_prefixed_f.read(name), prefixed_f.read(name))
+
     def test_is_prefixed(self):
         with IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages.idml")) as idml_file:
             self.assertFalse(idml_file.is_prefixed("foo"))
@@ -2042,6 +2287,56 @@ u"""<Root Self="FOOdi2">
                     # Graphics.
                     self.assertTrue(f.graphic.dom.xpath(".//Swatch[@Self='article1Swatch/None']"))
 
+    def test_insert_idml_xml_structure_update(self):
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "4-pages.idml"),
+                     os.path.join(OUTPUT_DIR, "4-pages-insert-article-1-photo.idml"))
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo.idml"),
+                     os.path.join(OUTPUT_DIR, "article-1photo.idml"))
+
+        with IDMLPackage(os.path.join(OUTPUT_DIR, "4-pages-insert-article-1-photo.idml")) as main_idml_file,\
+             IDMLPackage(os.path.join(OUTPUT_DIR, "article-1photo.idml")) as article_idml_file:
+            with main_idml_file.prefix("main") as prefixed_main,\
+                 article_idml_file.prefix("article1") as prefixed_article:
+                with prefixed_main.edit() as session:
+                    xml_structure = prefixed_main.xml_structure
+                    session.insert_idml(prefixed_article, at="/Root/article[3]", only="/Root/module[1]")
+                    # The xml_structure is updated in place rather than discovered again.
+                    self.assertTrue(prefixed_main.xml_structure is xml_structure)
+                    self.assertEqual(etree.tostring(xml_structure),
+                                     etree.tostring(prefixed_main._discover_xml_structure()))
+                with session.package as f:
+                    self.assertEqual(f.xml_structure_pretty(), etree.tostring(xml_structure, pretty_print=True))
+
+    def test_insert_idmls(self):
+        contents = {}
+        for name in ("4-pages.idml", "article-1photo.idml", "2articles-1photo.idml"):
+            with open(os.path.join(IDMLFILES_DIR, name), "rb") as f:
+                contents[name] = f.read()
+        content = contents["4-pages.idml"]
+
+        with IDMLPackage(BytesIO(contents["article-1photo.idml"])) as article_idml_file,\
+             IDMLPackage(BytesIO(contents["2articles-1photo.idml"])) as articles_idml_file:
+            insertions = [(article_idml_file.prefix("article1"), "/Root/article[3]", "/Root/module[1]"),
+                          (articles_idml_file.prefix("article2"), "/Root/article[1]", "/Root/module[1]")]
+
+            with IDMLPackage(BytesIO(content)) as main_idml_file:
+                f = main_idml_file.prefix("main").insert_idmls(insertions)
+            # Same result than one insertion after the other.
+            with IDMLPackage(BytesIO(content)) as main_idml_file:
+                prefixed_main = main_idml_file.prefix("main")
+                for idml_package, at, only in insertions:
+                    prefixed_main = prefixed_main.insert_idml(idml_package, at, only)
+            self.assertEqual(f.namelist(), prefixed_main.namelist())
+            for name in f.namelist():
+                self.assertEqual(f.read(name), prefixed_main.read(name))
+            self.assertTrue(set(['Stories/Story_article1u188.xml',
+                                 'Stories/Story_article2u188.xml']).issubset(f.stories))
+            # The font families of the modules are merged with the ones of the document.
+            families = [family.get("Name") for family in f.font_families]
+            self.assertEqual(len(families), len(set(families)))
+            styles = [elt.get("Self") for elt in f.style.dom.iter() if elt.get("Self")]
+            self.assertEqual(len(styles), len(set(styles)))
+
     def test_insert_idml_with_complex_source(self):
         shutil.copy2(os.path.join(IDMLFILES_DIR, "4-pages.idml"),
                      os.path.join(OUTPUT_DIR, "4-pages-insert-article-1-photo-complex.idml"))
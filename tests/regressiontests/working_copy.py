@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import os
+import shutil
+import unittest
+import zipfile
+from io import BytesIO
+from simple_idml.components import Story
+from simple_idml.idml import IDMLPackage
+from simple_idml.working_copy import DiskWorkingCopy, MemoryWorkingCopy
+
+CURRENT_DIR = os.path.dirname(__file__)
+IDMLFILES_DIR = os.path.join(CURRENT_DIR, "IDML")
+OUTPUT_DIR = os.path.join(CURRENT_DIR, "outputs", "working_copy")
+
+
+class MemoryWorkingCopyTestCase(unittest.TestCase):
+    def setUp(self):
+        super(MemoryWorkingCopyTestCase, self).setUp()
+        for f in glob.glob(os.path.join(OUTPUT_DIR, "*")):
+            os.unlink(f)
+        if not (os.path.exists(OUTPUT_DIR)):
+            os.makedirs(OUTPUT_DIR)
+
+    def test_extract(self):
+        with IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages.idml")) as idml_file:
+            working_copy = MemoryWorkingCopy()
+            working_copy.extract(idml_file)
+            # The archive order is kept.
+            self.assertEqual(working_copy.namelist(), idml_file.namelist())
+            self.assertEqual(working_copy.read("mimetype"), "application/vnd.adobe.indesign-idml-package")
+
+    def test_open(self):
+        working_copy = MemoryWorkingCopy()
+        self.assertRaises(IOError, working_copy.open, "Stories/Story_u1.xml")
+
+        fobj = working_copy.open("Stories/Story_u1.xml", mode="w+")
+        fobj.write("<Story/>")
+        self.assertFalse(working_copy.exists("Stories/Story_u1.xml"))
+        fobj.close()
+        self.assertTrue(working_copy.exists("Stories/Story_u1.xml"))
+        self.assertEqual(working_copy.read("Stories/Story_u1.xml"), "<Story/>")
+
+        working_copy.copy("Stories/Story_u1.xml", "Stories/Story_u2.xml")
+        working_copy.rename("Stories/Story_u1.xml", "Stories/Story_FOOu1.xml")
+        self.assertEqual(working_copy.namelist(), ["Stories/Story_FOOu1.xml", "Stories/Story_u2.xml"])
+
+    def test_synchronize(self):
+        with IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages.idml")) as idml_file:
+            working_copy = MemoryWorkingCopy()
+            working_copy.extract(idml_file)
+
+            story = Story(idml_file, "Stories/Story_u102.xml", working_copy)
+            story.node.set("StoryTitle", "Foo")
+            story.dirty = True
+            story.synchronize()
+
+            # The DOM is shared with the next instances and serialized on demand.
+            self.assertTrue(Story(idml_file, "Stories/Story_u102.xml", working_copy).dom is story.dom)
+            self.assertTrue('StoryTitle="Foo"' in working_copy.read("Stories/Story_u102.xml"))
+
+    def test_synchronize_not_modified(self):
+        with IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages.idml")) as idml_file:
+            working_copy = MemoryWorkingCopy()
+            working_copy.extract(idml_file)
+
+            story = Story(idml_file, "Stories/Story_u102.xml", working_copy)
+            story.get_element_by_id("di2i3")
+            story.synchronize()
+            self.assertFalse(story.dirty)
+            self.assertFalse(working_copy.is_modified("Stories/Story_u102.xml"))
+
+            story.set_element_attributes("di2i3", {"foo": "bar"})
+            self.assertTrue(story.dirty)
+            story.synchronize()
+            self.assertFalse(story.dirty)
+            self.assertTrue(working_copy.is_modified("Stories/Story_u102.xml"))
+
+    def test_locate(self):
+        idml_filename = os.path.join(IDMLFILES_DIR, "4-pages.idml")
+        with IDMLPackage(idml_filename) as idml_file:
+            working_copy = MemoryWorkingCopy()
+            working_copy.extract(idml_file)
+            # The untouched members are read in the package, with their former name.
+            working_copy.rename("Stories/Story_u102.xml", "Stories/Story_FOOu102.xml")
+            self.assertEqual(working_copy.locate("Stories/Story_FOOu102.xml"),
+                             (idml_filename, "Stories/Story_u102.xml"))
+
+            story = Story(idml_file, "Stories/Story_FOOu102.xml", working_copy)
+            story.set_element_attributes("di2i3", {"foo": "bar"})
+            story.synchronize()
+            self.assertEqual(working_copy.locate("Stories/Story_FOOu102.xml"), None)
+
+        with open(idml_filename, "rb") as f, IDMLPackage(BytesIO(f.read())) as idml_file:
+            working_copy = MemoryWorkingCopy()
+            working_copy.extract(idml_file)
+            self.assertEqual(working_copy.locate("Stories/Story_u102.xml"), None)
+
+    def test_repack(self):
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "4-pages.idml"),
+                     os.path.join(OUTPUT_DIR, "4-pages.idml"))
+
+        with IDMLPackage(os.path.join(OUTPUT_DIR, "4-pages.idml")) as idml_file:
+            infos = dict([(i.filename, i) for i in idml_file.infolist()])
+            with idml_file.suffix_layers(" - 23") as f:
+                self.assertEqual(os.listdir(OUTPUT_DIR), ["4-pages.idml"])
+                self.assertEqual(f.testzip(), None)
+                self.assertEqual(f.namelist(), [i.filename for i in idml_file.infolist()])
+                # The untouched members are copied as they are.
+                for info in f.infolist():
+                    if info.filename == "designmap.xml":
+                        self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+                    else:
+                        self.assertEqual(info.compress_type, infos[info.filename].compress_type)
+                        self.assertEqual(info.CRC, infos[info.filename].CRC)
+
+    def test_repack_error(self):
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "4-pages.idml"),
+                     os.path.join(OUTPUT_DIR, "4-pages.idml"))
+        with open(os.path.join(OUTPUT_DIR, "4-pages.idml"), "rb") as f:
+            content = f.read()
+
+        class FailingWorkingCopy(MemoryWorkingCopy):
+            def write_package(self, filename):
+                with open(filename, "wb") as f:
+                    f.write("PK")
+                raise IOError("No space left on device")
+
+        # The package is left as it is.
+        idml_file = IDMLPackage(os.path.join(OUTPUT_DIR, "4-pages.idml"))
+        idml_file.working_copy_class = FailingWorkingCopy
+        self.assertRaises(IOError, idml_file.suffix_layers, " - 23")
+        self.assertEqual(os.listdir(OUTPUT_DIR), ["4-pages.idml"])
+        with open(os.path.join(OUTPUT_DIR, "4-pages.idml"), "rb") as f:
+            self.assertEqual(f.read(), content)
+
+    def test_use_working_copy(self):
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "4-pages.idml"),
+                     os.path.join(OUTPUT_DIR, "4-pages.idml"))
+
+        with IDMLPackage(os.path.join(OUTPUT_DIR, "4-pages.idml")) as idml_file:
+            self.assertEqual(idml_file.working_copy_class, MemoryWorkingCopy)
+            with idml_file.prefix("FOO") as prefixed_f:
+                self.assertEqual(prefixed_f.working_copy, None)
+                self.assertEqual(prefixed_f.namelist()[0], "mimetype")
+                self.assertEqual(set(prefixed_f.stories), set([
+                    'Stories/Story_FOOu102.xml',
+                    'Stories/Story_FOOu11b.xml',
+                    'Stories/Story_FOOu139.xml',
+                    'Stories/Story_FOOue4.xml']
+                ))
+
+    def test_disk_working_copy(self):
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "4-pages.idml"),
+                     os.path.join(OUTPUT_DIR, "4-pages.idml"))
+
+        with IDMLPackage(os.path.join(OUTPUT_DIR, "4-pages.idml")) as idml_file:
+            idml_file.working_copy_class = DiskWorkingCopy
+            with idml_file.prefix("FOO") as prefixed_f:
+                self.assertEqual(prefixed_f.testzip(), None)
+                self.assertEqual(set(prefixed_f.spreads), set([
+                    'Spreads/Spread_FOOub6.xml',
+                    'Spreads/Spread_FOOubc.xml',
+                    'Spreads/Spread_FOOuc3.xml']
+                ))
+
+
+class EditSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        super(EditSessionTestCase, self).setUp()
+        for f in glob.glob(os.path.join(OUTPUT_DIR, "*")):
+            os.unlink(f)
+        if not (os.path.exists(OUTPUT_DIR)):
+            os.makedirs(OUTPUT_DIR)
+
+    def test_edit(self):
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "4-pages.idml"),
+                     os.path.join(OUTPUT_DIR, "4-pages.idml"))
+
+        idml_file = IDMLPackage(os.path.join(OUTPUT_DIR, "4-pages.idml"))
+        with idml_file.edit() as session:
+            # Chained methods share the same working copy.
+            self.assertTrue(session.prefix("FOO") is idml_file)
+            self.assertTrue(session.suffix_layers(" - 23") is idml_file)
+            self.assertEqual(idml_file.working_copy, session.working_copy)
+            self.assertRaises(ValueError, idml_file.edit().__enter__)
+
+        self.assertEqual(idml_file.working_copy, None)
+        with session.package as f:
+            self.assertFalse(f is idml_file)
+            self.assertEqual(f.designmap.layer_nodes[0].get("Name"), "Layer 1 - 23")
+            self.assertTrue(f.is_prefixed("FOO"))
+
+    def test_edit_with_exception(self):
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "4-pages.idml"),
+                     os.path.join(OUTPUT_DIR, "4-pages.idml"))
+
+        with IDMLPackage(os.path.join(OUTPUT_DIR, "4-pages.idml")) as idml_file:
+            def _edit():
+                with idml_file.edit() as session:
+                    session.prefix("FOO")
+                    session.prefix("bad-prefix")
+            self.assertRaises(BaseException, _edit)
+            # The package is left untouched.
+            self.assertEqual(idml_file.working_copy, None)
+            self.assertFalse(idml_file.is_prefixed("FOO"))
+
+
+def suite():
+    suite = unittest.TestLoader().loadTestsFromTestCase(MemoryWorkingCopyTestCase)
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(EditSessionTestCase))
+    return suite